@@ -7,12 +7,11 @@ import argparse
 import logging
 import sys
 import typing
-import fuse
 
 __author__ = 'Kamil Janiec <kamil.janiec@nokia.com>'
 
 
-from . import ec2fs, ec2_proxy
+from . import ec2fs, ec2_proxy, event_feed, fake_ec2, fuse_mount
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,9 +24,35 @@ def _parse_args(args: typing.List[str]) -> argparse.Namespace:
                         help='Turn on debug logging.')
     parser.add_argument('--mock', action='store_true', default=False,
                         help='Turn on ec2 mock.')
+    parser.add_argument('--fake', action='store_true', default=False,
+                        help='Use fast in-process fake of ec2 instead of the API.')
+    parser.add_argument('--fake-instances', type=int, default=1000,
+                        help='Number of instances generated by the fake.')
+    parser.add_argument('--fake-images', type=int, default=100,
+                        help='Number of images generated by the fake.')
+    parser.add_argument('--fake-latency', type=float, default=0,
+                        help='Latency (in seconds) of every call to the fake.')
+    parser.add_argument('--fake-throttling-rate', type=float, default=0,
+                        help='Fraction of calls to the fake that are throttled.')
+    parser.add_argument('--fake-transition-time', type=float, default=0,
+                        help='Time (in seconds) instances of the fake spend in transitional states.')
+    parser.add_argument('--fake-seed', type=int, default=0,
+                        help='Seed of everything random in the fake.')
     parser.add_argument('--background', action='store_true', default=False,
                         help='Run as background process.')
     parser.add_argument('--region-name', default='us-east-2')
+    parser.add_argument('--connect-timeout', type=float, default=5,
+                        help='Timeout (in seconds) of connecting to the API.')
+    parser.add_argument('--read-timeout', type=float, default=15,
+                        help='Timeout (in seconds) of reading from the API.')
+    parser.add_argument('--max-attempts', type=int, default=2,
+                        help='Number of attempts (including the first one) of every call to the API.')
+    parser.add_argument('--refresh-interval', type=float, default=None,
+                        help='Refresh cached instances every REFRESH_INTERVAL seconds.')
+    parser.add_argument('--event-spool', default=None,
+                        help='NDJSON file with EC2 instance state-change events to follow.')
+    parser.add_argument('--shared-cache', default=None,
+                        help='File through which mounts on this host share one cache.')
     parser.add_argument('mountpoint', help='Empty directory where fs will be mounted.')
     return parser.parse_args(args)
 
@@ -45,9 +70,20 @@ def _setup_logger(debug: bool = False) -> None:
                         format=logging_format)
 
 
-def _spawn_fuse(region_name, mountpoint, foreground=True):
-    fuse.FUSE(
-        ec2fs.ec2fs(ec2_proxy.ec2_proxy()),
+def _spawn_fuse(region_name, mountpoint, foreground=True, refresh_interval=None,
+                event_spool=None, shared_cache=None, backend=None,
+                connect_timeout=5, read_timeout=15, max_attempts=2):
+    proxy = ec2_proxy.ec2_proxy(region_name=region_name,
+                                refresh_interval=refresh_interval,
+                                shared_cache_path=shared_cache,
+                                backend=backend,
+                                connect_timeout=connect_timeout,
+                                read_timeout=read_timeout,
+                                max_attempts=max_attempts)
+    if event_spool:
+        proxy.register_worker(event_feed.event_feed(proxy, event_spool))
+    fuse_mount.fuse_mount(
+        ec2fs.ec2fs(proxy),
         mountpoint,
         foreground=foreground,
         allow_other=True,
@@ -69,9 +105,25 @@ def main() -> None:
         print('MOCKED')
         import moto
         with moto.mock_ec2():
-            _spawn_fuse(args.region_name, args.mountpoint, foreground)
+            _spawn_fuse(args.region_name, args.mountpoint, foreground,
+                        args.refresh_interval, args.event_spool, args.shared_cache,
+                        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                        max_attempts=args.max_attempts)
+    elif args.fake:
+        print('FAKED')
+        backend = fake_ec2.fake_ec2(instances_count=args.fake_instances,
+                                    images_count=args.fake_images,
+                                    latency=args.fake_latency,
+                                    throttling_rate=args.fake_throttling_rate,
+                                    transition_time=args.fake_transition_time,
+                                    seed=args.fake_seed)
+        _spawn_fuse(args.region_name, args.mountpoint, foreground,
+                    args.refresh_interval, args.event_spool, args.shared_cache, backend)
     else:
-        _spawn_fuse(args.region_name, args.mountpoint, foreground)
+        _spawn_fuse(args.region_name, args.mountpoint, foreground,
+                    args.refresh_interval, args.event_spool, args.shared_cache,
+                    connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                    max_attempts=args.max_attempts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+""" This module contains circuit_breaker class. """
+
+
+import threading
+import time
+
+
+class circuit_breaker:
+    """ This class tracks failures of some operation and tells whether it should be attempted.
+
+        Circuit is closed at first - operation is attempted. After `failure_threshold`
+        consecutive failures it opens - operation should fail fast without being attempted.
+        After `reset_timeout` seconds it's half-open - single attempt (probe) is allowed,
+        its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """ Return current state of the circuit. """
+        with self._lock:
+            if self._opened is None:
+                return circuit_breaker.CLOSED
+            if time.monotonic() - self._opened < self._reset_timeout:
+                return circuit_breaker.OPEN
+            return circuit_breaker.HALF_OPEN
+
+    def allow(self) -> bool:
+        """ Return True if operation should be attempted (it's a probe in half-open state). """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or time.monotonic() - self._opened < self._reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        """ Record successful attempt - it closes the circuit. """
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._probing = False
+
+    def cancel(self) -> None:
+        """ Record that allowed attempt was not made after all - it does not change
+            the state, but another probe can be let through in half-open state.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        """ Record failed attempt - it might open the circuit. """
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self._failure_threshold:
+                self._opened = time.monotonic()
+            self._probing = False
@@ -0,0 +1,75 @@
+""" This module contains coalescing_fetcher class. """
+
+
+import logging
+import threading
+import time
+import typing
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class coalescing_fetcher:
+    """ This class coalesces concurrent requests to fetch single keys into batched fetches.
+
+        The first thread that requests a key waits a moment (so other threads can join
+        its batch) and then calls fetch callback with all the keys of the batch. Threads
+        that request a key which is already being fetched just wait for that fetch.
+
+        Results are not returned - fetch callback is expected to store them somewhere
+        (e.g. in guarded_kv_store). Keys can be also fetched in background - then
+        requesting the same key again does not start another fetch until it's done.
+    """
+
+    def __init__(self, fetch: typing.Callable[[typing.List[typing.Hashable]], None],
+                 max_batch_size: int = 200, delay: float = 0.01) -> None:
+        self._fetch = fetch
+        self._max_batch_size = max_batch_size
+        self._delay = delay
+
+        self._lock = threading.Lock()
+        self._collecting = None
+        self._batches = {}
+
+    def fetch(self, key: typing.Hashable, wait: bool = True) -> None:
+        """ Fetch given key (along with keys requested concurrently) and wait until it's done
+            - unless `wait` is False, then the fetch is done in background.
+        """
+        leader = False
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                if self._collecting is None or len(self._collecting['keys']) >= self._max_batch_size:
+                    self._collecting = {'keys': [], 'done': threading.Event()}
+                    leader = True
+                batch = self._collecting
+                batch['keys'].append(key)
+                self._batches[key] = batch
+
+        if leader and wait:
+            self._run(batch)
+        elif leader:
+            threading.Thread(target=self._run, args=(batch,),
+                             name='coalescing_fetcher', daemon=True).start()
+        elif wait:
+            batch['done'].wait()
+
+    def _run(self, batch: dict) -> None:
+        """ Collect keys for a moment and fetch them. """
+        time.sleep(self._delay)
+
+        with self._lock:
+            if self._collecting is batch:
+                self._collecting = None
+
+        try:
+            self._fetch(batch['keys'])
+        except Exception:
+            LOGGER.exception('Failed to fetch: %r', batch['keys'])
+        finally:
+            with self._lock:
+                for key in batch['keys']:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+            batch['done'].set()
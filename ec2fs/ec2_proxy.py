@@ -1,18 +1,26 @@
 """ This module contains ec2_proxy class. """
 
 
+import collections
+import csv
+import io
 import itertools
 import logging
 import os
+import re
+import threading
+import time
 import typing
 import uuid
 
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import expiringdict
 
 
-from . import guarded_kv_store
+from . import circuit_breaker, coalescing_fetcher, guarded_kv_store, shared_cache
 
 
 LOGGER = logging.getLogger(__name__)
@@ -29,14 +37,122 @@ class ec2_proxy:
 
     FLAVORS_FILE = f'{os.path.dirname(os.path.realpath(__file__))}/miscellaneous/flavors.txt'
     REQUESTS_LIMITS = {'max_len': 1000, 'max_age_seconds': 1500}
-
-    def __init__(self, region_name: str = 'us-east-2') -> None:
-        self._ec2 = boto3.client('ec2', region_name=region_name)
+    # Every method has its own circuit breaker - after failure_threshold consecutive
+    # failures calls fail fast (without calling the API) for reset_timeout seconds.
+    CIRCUIT_BREAKER_LIMITS = {'failure_threshold': 5, 'reset_timeout': 30}
+    # Error codes of synthetic responses - created when there is no response from the API.
+    CIRCUIT_OPEN_ERROR_CODE = 'CircuitBreakerOpen'
+    ENDPOINT_ERROR_CODE = 'EndpointUnavailable'
+    INVALID_REQUEST_ERROR_CODE = 'InvalidRequest'
+    READ_ONLY_ERROR_CODE = 'SharedCacheReadOnly'
+    # Errors raised when the endpoint is not reachable (or it does not respond in time).
+    ENDPOINT_ERRORS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError,
+                       ConnectionError, TimeoutError)
+
+    # Ids confirmed missing by lookups are remembered for a short time, so
+    # repeated lookups of the same id do not call the API over and over.
+    MISSING_IDS_LIMITS = {'max_len': 10000, 'max_age_seconds': 5}
+
+    # Cached resources older than this many seconds are still returned by lookups,
+    # but they are re-described in background (None means they never get stale).
+    FRESHNESS_TTLS = {'instances': 10, 'images': 3600, 'flavors': None}
+
+    INSTANCE_ID_PATTERN = re.compile(r'^i-[0-9a-f]{8,17}$')
+    IMAGE_ID_PATTERN = re.compile(r'^ami-[0-9a-f]{8,17}$')
+
+    # Delta refreshes re-describe changed instances in batches of this size,
+    # full refreshes page through describe_instances with pages of this size.
+    DESCRIBE_BATCH_SIZE = 200
+    PAGE_SIZE = 1000
+    # Full refresh is done at least once per this many seconds, because some
+    # changes (e.g. tags) are not visible in describe_instance_status.
+    FULL_REFRESH_INTERVAL = 600
+
+    # Columns of instances CSV table: (header, path to the value in instance data).
+    INSTANCES_CSV_COLUMNS = (
+        ('InstanceId', ('InstanceId',)),
+        ('InstanceType', ('InstanceType',)),
+        ('State', ('State', 'Name')),
+        ('ImageId', ('ImageId',)),
+        ('LaunchTime', ('LaunchTime',)),
+        ('AvailabilityZone', ('Placement', 'AvailabilityZone')),
+        ('PrivateIpAddress', ('PrivateIpAddress',)),
+        ('PublicIpAddress', ('PublicIpAddress',)),
+        ('VpcId', ('VpcId',)),
+        ('SubnetId', ('SubnetId',))
+    )
+
+    INSTANCE_STATE_CODES = {
+        'pending': 0,
+        'running': 16,
+        'shutting-down': 32,
+        'terminated': 48,
+        'stopping': 64,
+        'stopped': 80
+    }
+
+    def __init__(self, region_name: str = 'us-east-2',
+                 refresh_interval: typing.Optional[float] = None,
+                 shared_cache_path: typing.Optional[str] = None,
+                 backend: typing.Any = None,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 15,
+                 max_attempts: int = 2) -> None:
+        # Backend is any object that implements used methods of boto3 ec2 client
+        # (e.g. fake_ec2) - by default it's the client itself.
+        if backend is None:
+            backend = boto3.client('ec2', region_name=region_name, config=botocore.config.Config(
+                connect_timeout=connect_timeout, read_timeout=read_timeout,
+                # Attempts include the first call - single call takes at most
+                # max_attempts * (connect_timeout + read_timeout) seconds plus short backoff.
+                retries={'mode': 'standard', 'total_max_attempts': max_attempts}))
+        self._ec2 = backend
+        self._circuit_breakers = collections.defaultdict(
+            lambda: circuit_breaker.circuit_breaker(**ec2_proxy.CIRCUIT_BREAKER_LIMITS))
+
+        self._refresh_interval = refresh_interval
+        self._read_only = False
+        self._last_full_refresh = None
+        # States of instances seen by the last refresh - delta refresh compares
+        # polled states with them (cached states might be patched by events).
+        self._polled_states = {}
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._poller = None
+        self._workers = []
+        self._instances_csv_rows = {}
+
+        self._missing_instance_ids = expiringdict.ExpiringDict(**ec2_proxy.MISSING_IDS_LIMITS)
+        self._missing_image_ids = expiringdict.ExpiringDict(**ec2_proxy.MISSING_IDS_LIMITS)
+        self._instances_fetcher = coalescing_fetcher.coalescing_fetcher(
+            self._fetch_instances, max_batch_size=ec2_proxy.DESCRIBE_BATCH_SIZE)
+        self._images_fetcher = coalescing_fetcher.coalescing_fetcher(
+            self._fetch_images, max_batch_size=ec2_proxy.DESCRIBE_BATCH_SIZE)
 
         self._instances = guarded_kv_store.guarded_kv_store()
         self._images = guarded_kv_store.guarded_kv_store()
         self._flavors = guarded_kv_store.guarded_kv_store()
 
+        # With shared cache only one process on the host (the owner) refreshes instances
+        # and images - other processes serve them from the snapshot published by the owner.
+        self._shared_cache = None
+        if shared_cache_path:
+            cache = self._shared_cache = shared_cache.shared_cache(
+                shared_cache_path, on_acquire=self._take_over_shared_cache)
+            if cache.acquire():
+                LOGGER.info('Publishing cache to "%s"', shared_cache_path)
+                cache.register_store('instances', self._instances)
+                cache.register_store('images', self._images)
+            else:
+                LOGGER.info('Attaching to cache published to "%s"', shared_cache_path)
+                LOGGER.warning('Instances created through this mount show up once the owner '
+                               'of shared cache refreshes them')
+                self._instances = cache.view('instances')
+                self._images = cache.view('images')
+                self._read_only = True
+            # Cache is published by the owner - other processes wait to take it over.
+            self.register_worker(cache)
+
         # Requests are not kept in the memory for ever.
         #
         # I don't like the idea of creating an interface to delete
@@ -46,7 +162,8 @@ class ec2_proxy:
         # Limitations are defined as ec2_proxy.REQUESTS_LIMITS.
         self._requests = guarded_kv_store.guarded_kv_store(
             dict_cls=lambda: expiringdict.ExpiringDict(
-                **ec2_proxy.REQUESTS_LIMITS))
+                **ec2_proxy.REQUESTS_LIMITS),
+            volatile=True)
 
         try:
             with open(ec2_proxy.FLAVORS_FILE, 'r') as fh:
@@ -68,6 +185,31 @@ class ec2_proxy:
                            ec2_proxy.FLAVORS_FILE)
 
 
+    def register_worker(self, worker: typing.Any) -> None:
+        """ Register object (with start and stop methods) that should
+            be started and stopped along with the proxy.
+        """
+        self._workers.append(worker)
+
+    def start(self) -> None:
+        """ Start polling for instances (if refresh_interval was specified
+            and the cache is not refreshed by the owner of shared cache)
+            and registered workers.
+        """
+        if not self._read_only:
+            self._start_poller()
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self) -> None:
+        """ Stop polling for instances and registered workers. """
+        for worker in self._workers:
+            worker.stop()
+        self._stop_event.set()
+        if self._poller:
+            self._poller.join()
+            self._poller = None
+
     def get_cached_instance(self, instance_id) -> dict:
         """ Return specified instance that was cached. """
         return self._instances.get(instance_id)
@@ -80,6 +222,42 @@ class ec2_proxy:
         """ Return specified request that was cached. """
         return self._requests.get(request_id)
 
+    def lookup_instance(self, instance_id) -> typing.Optional[dict]:
+        """ Return specified instance - if it's not cached, describe it first
+            (unless it was recently confirmed missing), if it's stale, return it
+            and describe it in background.
+        """
+        instance = self._instances.get(instance_id)
+        if self._read_only:
+            # Shared cache is refreshed by its owner.
+            return instance
+        if instance is None:
+            if (ec2_proxy.INSTANCE_ID_PATTERN.match(instance_id) and
+                    instance_id not in self._missing_instance_ids):
+                self._instances_fetcher.fetch(instance_id)
+                instance = self._instances.get(instance_id)
+        elif ec2_proxy._is_stale(instance, ec2_proxy.FRESHNESS_TTLS['instances']):
+            self._instances_fetcher.fetch(instance_id, wait=False)
+        return instance
+
+    def lookup_image(self, image_id) -> typing.Optional[dict]:
+        """ Return specified image - if it's not cached, describe it first
+            (unless it was recently confirmed missing), if it's stale, return it
+            and describe it in background.
+        """
+        image = self._images.get(image_id)
+        if self._read_only:
+            # Shared cache is refreshed by its owner.
+            return image
+        if image is None:
+            if (ec2_proxy.IMAGE_ID_PATTERN.match(image_id) and
+                    image_id not in self._missing_image_ids):
+                self._images_fetcher.fetch(image_id)
+                image = self._images.get(image_id)
+        elif ec2_proxy._is_stale(image, ec2_proxy.FRESHNESS_TTLS['images']):
+            self._images_fetcher.fetch(image_id, wait=False)
+        return image
+
     def get_cached_instances(self) -> typing.List[typing.Dict[str, dict]]:
         """ Return instances that were cached. """
         return self._instances.bulk_get()
@@ -96,6 +274,30 @@ class ec2_proxy:
         """ Return requests that were cached. """
         return self._requests.bulk_get()
 
+    def get_cached_instance_ids(self) -> typing.Tuple[str, ...]:
+        """ Return sorted ids of instances that were cached. """
+        return self._instances.keys()
+
+    def get_cached_image_ids(self) -> typing.Tuple[str, ...]:
+        """ Return sorted ids of images that were cached. """
+        return self._images.keys()
+
+    def get_cached_request_ids(self) -> typing.Tuple[str, ...]:
+        """ Return sorted ids of requests that were cached. """
+        return self._requests.keys()
+
+    def get_cached_instances_ndjson(self) -> bytes:
+        """ Return cached instances as NDJSON document (sorted by instance id). """
+        return self._instances.aggregate('ndjson', ec2_proxy._ndjson_builder)
+
+    def get_cached_images_ndjson(self) -> bytes:
+        """ Return cached images as NDJSON document (sorted by image id). """
+        return self._images.aggregate('ndjson', ec2_proxy._ndjson_builder)
+
+    def get_cached_instances_csv(self) -> bytes:
+        """ Return cached instances as CSV table (with ec2_proxy.INSTANCES_CSV_COLUMNS). """
+        return self._instances.aggregate('csv', self._instances_csv_builder)
+
     def run_instances(self, **kwargs) -> dict:
         """ Run run_instances, cache the response, cache created instances,
             and return the response.
@@ -110,11 +312,12 @@ class ec2_proxy:
 
         return response
 
-    def describe_instances(self, **kwargs) -> dict:
-        """ Run describe_instances, cache the response, cache described instances,
-            and return the response.
+    def describe_instances(self, cache_response: bool = True, **kwargs) -> dict:
+        """ Run describe_instances, cache the response (unless `cache_response` is False),
+            cache described instances, and return the response.
         """
-        response, status_code = self._run_boto3_method('describe_instances', **kwargs)
+        response, status_code = self._run_boto3_method(
+            'describe_instances', cache_response=cache_response, **kwargs)
 
         if status_code == 200:
             self._instances.bulk_insert(
@@ -135,15 +338,78 @@ class ec2_proxy:
         if status_code == 200:
             instance_ids = [instance['InstanceId']
                             for instance in response['TerminatingInstances']]
-            self.describe_instances(InstanceIds=instance_ids)
+            self.describe_instances(cache_response=False, InstanceIds=instance_ids)
 
         return response
 
-    def describe_images(self, **kwargs) -> dict:
-        """ Run describe_images, cache the response, cache described images,
-            and return the response.
+    def refresh_instances(self, full: bool = False) -> dict:
+        """ Bring cached instances up to date with the account and return the status
+            of the refresh - or the response of the call that failed.
+
+            By default only instances which changed their state (or appeared) since
+            the last refresh are re-described - changes are detected with cheap
+            describe_instance_status calls. Full refresh is done if `full` is specified,
+            on the first refresh and every ec2_proxy.FULL_REFRESH_INTERVAL seconds.
+        """
+        if self._read_only:
+            LOGGER.info('Refresh skipped - cache is refreshed by the owner of shared cache')
+            return ec2_proxy._synthetic_response(
+                ec2_proxy.READ_ONLY_ERROR_CODE, 409,
+                'Cache is refreshed by the owner of shared cache.')
+
+        with self._refresh_lock:
+            full = (full or self._last_full_refresh is None or
+                    time.time() - self._last_full_refresh > ec2_proxy.FULL_REFRESH_INTERVAL)
+            if full:
+                failed_response = self._full_refresh_instances()
+            else:
+                failed_response = self._delta_refresh_instances()
+
+        if failed_response is not None:
+            return failed_response
+        return {'Status': 'done', 'Full': full}
+
+    def apply_instance_states(self, states: typing.Dict[str, str]) -> None:
+        """ Update cached state of given instances (instance_id -> state name)
+            without calling the API - instances missing from cache are described.
         """
-        response, status_code = self._run_boto3_method('describe_images', **kwargs)
+        missing_ids = self._instances.bulk_update(
+            ((instance_id, {'State': ec2_proxy._instance_state(state)})
+             for instance_id, state in states.items()),
+            key_error_ok=True)
+
+        # Ids come from outside - they are described the same way as lookups,
+        # so nonexistent ones do not fail the whole batch.
+        missing_ids = [instance_id for instance_id in missing_ids
+                       if instance_id not in self._missing_instance_ids]
+        for i in range(0, len(missing_ids), ec2_proxy.DESCRIBE_BATCH_SIZE):
+            self._fetch_instances(missing_ids[i:i + ec2_proxy.DESCRIBE_BATCH_SIZE])
+
+    def reject_request(self, message: str) -> dict:
+        """ Cache and return InvalidRequest response of request that could not be made
+            (e.g. its payload is malformed).
+        """
+        response = ec2_proxy._synthetic_response(
+            ec2_proxy.INVALID_REQUEST_ERROR_CODE, 400, message)
+        request_id = response['ResponseMetadata']['RequestId']
+        self._requests.insert(key=request_id, value=response)
+        LOGGER.error('Request rejected: %s / request_id: "%s"', message, request_id)
+        return response
+
+    def describe_instance_status(self, cache_response: bool = True, **kwargs) -> dict:
+        """ Run describe_instance_status, cache the response (unless `cache_response`
+            is False), and return it.
+        """
+        response, _ = self._run_boto3_method(
+            'describe_instance_status', cache_response=cache_response, **kwargs)
+        return response
+
+    def describe_images(self, cache_response: bool = True, **kwargs) -> dict:
+        """ Run describe_images, cache the response (unless `cache_response` is False),
+            cache described images, and return the response.
+        """
+        response, status_code = self._run_boto3_method(
+            'describe_images', cache_response=cache_response, **kwargs)
 
         if status_code == 200:
             self._images.bulk_insert(
@@ -153,19 +419,277 @@ class ec2_proxy:
 
         return response
 
-    def _run_boto3_method(self, method_name: str, **kwargs) -> typing.Tuple[dict, int]:
-        """ Run _boto3_method, cache the response and return it. """
-        try:
-            response = getattr(self._ec2, method_name)(**kwargs)
-        except Exception as e:
-            response = e.response
+    def _full_refresh_instances(self) -> typing.Optional[dict]:
+        """ Re-describe all instances and drop the ones that no longer exist
+            - return the failed response if the refresh failed.
+        """
+        started = time.time()
+        # Only instances cached before the refresh started can be removed - the ones
+        # cached in the meantime (launched, looked up, ...) might be missing from pages.
+        cached_ids = self._instances.keys()
+
+        responses = self._paginate(self.describe_instances, cache_response=False)
+        if responses[-1]['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return responses[-1]
+
+        instance_ids = set(instance['InstanceId']
+                           for response in responses
+                           for reservation in response['Reservations']
+                           for instance in reservation['Instances'])
+        self._instances.bulk_remove(
+            [instance_id for instance_id in cached_ids
+             if instance_id not in instance_ids],
+            key_error_ok=True)
+
+        self._polled_states = {instance['InstanceId']: instance['State']['Name']
+                               for response in responses
+                               for reservation in response['Reservations']
+                               for instance in reservation['Instances']}
+
+        self._last_full_refresh = started
+
+    def _delta_refresh_instances(self) -> typing.Optional[dict]:
+        """ Re-describe only instances whose state changed since the last refresh
+            (or which are not cached) - return the failed response if the refresh failed.
+        """
+        # Only instances cached before the refresh started can be removed (see above).
+        cached_ids = self._instances.keys()
+
+        responses = self._paginate(self.describe_instance_status, cache_response=False,
+                                   IncludeAllInstances=True)
+        if responses[-1]['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return responses[-1]
+
+        states = {status['InstanceId']: status['InstanceState']['Name']
+                  for response in responses
+                  for status in response['InstanceStatuses']}
+
+        # Cached state is not compared - events update it without describing the instance,
+        # so other attributes (addresses, state reason, ...) would never be refreshed.
+        current_ids = set(self._instances.keys())
+        changed_ids = [instance_id for instance_id, state in states.items()
+                       if instance_id not in current_ids or
+                       self._polled_states.get(instance_id) != state]
+        self._instances.bulk_remove(
+            [instance_id for instance_id in cached_ids
+             if instance_id not in states],
+            key_error_ok=True)
+
+        LOGGER.debug('delta refresh: %d of %d instances changed',
+                     len(changed_ids), len(states))
+
+        failed_response = None
+        for i in range(0, len(changed_ids), ec2_proxy.DESCRIBE_BATCH_SIZE):
+            batch = changed_ids[i:i + ec2_proxy.DESCRIBE_BATCH_SIZE]
+            response = self._fetch_instances(batch)
+            if response is not None:
+                failed_response = response
+                # Instances that were not described are tried again by the next refresh.
+                for instance_id in batch:
+                    states.pop(instance_id, None)
+
+        self._polled_states = states
+        return failed_response
+
+    def _fetch_instances(self, instance_ids: typing.List[str]) -> typing.Optional[dict]:
+        """ Describe given instances and remember the ones that do not exist
+            - return the failed response if the call failed.
+        """
+        # Filter is used instead of InstanceIds - it does not fail the whole call
+        # when some of the instances do not exist.
+        response = self.describe_instances(
+            cache_response=False, Filters=[{'Name': 'instance-id', 'Values': instance_ids}])
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return response
+
+        found_ids = set(instance['InstanceId']
+                        for reservation in response['Reservations']
+                        for instance in reservation['Instances'])
+        missing_ids = [instance_id for instance_id in instance_ids
+                       if instance_id not in found_ids]
+        for instance_id in missing_ids:
+            self._missing_instance_ids[instance_id] = True
+        # Stale instances might have been removed in the meantime.
+        if missing_ids:
+            self._instances.bulk_remove(missing_ids, key_error_ok=True)
+
+    def _fetch_images(self, image_ids: typing.List[str]) -> None:
+        """ Describe given images and remember the ones that do not exist. """
+        response = self.describe_images(
+            cache_response=False, Filters=[{'Name': 'image-id', 'Values': image_ids}])
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return
+
+        found_ids = set(image['ImageId'] for image in response['Images'])
+        missing_ids = [image_id for image_id in image_ids
+                       if image_id not in found_ids]
+        for image_id in missing_ids:
+            self._missing_image_ids[image_id] = True
+        # Stale images might have been deregistered in the meantime.
+        if missing_ids:
+            self._images.bulk_remove(missing_ids, key_error_ok=True)
+
+    def _start_poller(self) -> None:
+        """ Start polling for instances if refresh_interval was specified. """
+        if not self._refresh_interval:
+            if self._shared_cache:
+                LOGGER.warning('Shared cache is published without refresh interval - changes '
+                               'made through other mounts will not show up in the cache')
+            return
+        if not self._poller:
+            self._stop_event.clear()
+            self._poller = threading.Thread(
+                target=self._poll, name='ec2_proxy-poller', daemon=True)
+            self._poller.start()
+
+    def _take_over_shared_cache(self, cache: 'ec2fs.shared_cache') -> None:
+        """ Become the owner of shared cache - it's called once the previous owner exited.
+
+            Last snapshot of the previous owner is the starting point, it's refreshed
+            (and published) by this process from now on.
+        """
+        if not self._read_only:
+            return
+
+        instances = guarded_kv_store.guarded_kv_store()
+        instances.bulk_insert((key, entry['data'])
+                              for key, entry in self._instances.bulk_get().items())
+        images = guarded_kv_store.guarded_kv_store()
+        images.bulk_insert((key, entry['data'])
+                           for key, entry in self._images.bulk_get().items())
+        cache.register_store('instances', instances)
+        cache.register_store('images', images)
+
+        self._instances, self._images = instances, images
+        self._read_only = False
+        self._start_poller()
+
+    def _poll(self) -> None:
+        """ Refresh instances every refresh_interval seconds until stopped. """
+        while not self._stop_event.wait(self._refresh_interval):
+            try:
+                self.refresh_instances()
+            except Exception:
+                LOGGER.exception('Failed to refresh instances')
+
+    @staticmethod
+    def _is_stale(entry: dict, ttl: typing.Optional[float]) -> bool:
+        """ Return True if cached entry is older than ttl seconds. """
+        return ttl is not None and time.time() - entry['metadata']['@updated_timestamp'] > ttl
+
+    @staticmethod
+    def _ndjson_builder(entries: typing.Dict[str, dict]) -> bytes:
+        """ Join already serialized entries into NDJSON document. """
+        if not entries:
+            return b''
+        return b'\n'.join(entries[key]['raw_data'] for key in sorted(entries)) + b'\n'
+
+    def _instances_csv_builder(self, entries: typing.Dict[str, dict]) -> bytes:
+        """ Build CSV table of instances - rows of entries that did not change
+            since the previous build are reused.
+        """
+        previous_rows = self._instances_csv_rows
+        rows = {}
+        for key in sorted(entries):
+            raw_data = entries[key]['raw_data']
+            if key in previous_rows and previous_rows[key][0] is raw_data:
+                rows[key] = previous_rows[key]
+            else:
+                rows[key] = (raw_data, ec2_proxy._csv_row(
+                    ec2_proxy._get_nested(entries[key]['data'], path)
+                    for _, path in ec2_proxy.INSTANCES_CSV_COLUMNS))
+        self._instances_csv_rows = rows
+
+        header = ec2_proxy._csv_row(name for name, _ in ec2_proxy.INSTANCES_CSV_COLUMNS)
+        return header + b''.join(row for _, row in rows.values())
+
+    @staticmethod
+    def _csv_row(values: typing.Iterable[typing.Any]) -> bytes:
+        """ Return single CSV row (with line terminator). """
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerow(values)
+        return buffer.getvalue().encode()
+
+    @staticmethod
+    def _get_nested(data: dict, path: typing.Tuple[str, ...]) -> typing.Any:
+        """ Return value under path in nested dict (or empty string if it's missing). """
+        for key in path:
+            if not isinstance(data, dict) or key not in data:
+                return ''
+            data = data[key]
+        return data
+
+    @staticmethod
+    def _instance_state(name: str) -> dict:
+        """ Return State structure (as returned by the API) of given state name. """
+        if name in ec2_proxy.INSTANCE_STATE_CODES:
+            return {'Code': ec2_proxy.INSTANCE_STATE_CODES[name], 'Name': name}
+        return {'Name': name}
+
+    @staticmethod
+    def _paginate(method: typing.Callable[..., dict], **kwargs) -> typing.List[dict]:
+        """ Call method until all pages are retrieved (or some page fails)
+            and return the responses - the failed one is the last one.
+        """
+        responses = []
+        kwargs['MaxResults'] = ec2_proxy.PAGE_SIZE
+        while True:
+            response = method(**kwargs)
+            responses.append(response)
+            if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+                return responses
+            if not response.get('NextToken'):
+                return responses
+            kwargs['NextToken'] = response['NextToken']
+
+    def _run_boto3_method(self, method_name: str, cache_response: bool = True,
+                          **kwargs) -> typing.Tuple[dict, int]:
+        """ Run _boto3_method, cache the response (unless `cache_response` is False
+            and the call succeeded) and return it.
+
+            Successful responses of internal calls (polling, lookups, ...) are not cached
+            - they would evict responses of user's requests from ec2_proxy._requests.
+
+            If there is no response (method's circuit breaker is open, endpoint is not
+            reachable, ...), synthetic one is created - it's cached as well.
+        """
+        breaker = self._circuit_breakers[method_name]
+        if not breaker.allow():
+            response = ec2_proxy._synthetic_response(
+                ec2_proxy.CIRCUIT_OPEN_ERROR_CODE, 503,
+                f'{method_name} is failing - it is not called for a while.')
+        else:
+            reached = True
+            try:
+                response = getattr(self._ec2, method_name)(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                response = e.response
+            except ec2_proxy.ENDPOINT_ERRORS as e:
+                # Connection errors, timeouts, ... - there is no response at all.
+                response = ec2_proxy._synthetic_response(
+                    ec2_proxy.ENDPOINT_ERROR_CODE, 503, f'{type(e).__name__}: {e}')
+            except Exception as e:
+                # Invalid parameters, ... - the request was not even sent,
+                # so it tells nothing about the endpoint.
+                response = ec2_proxy._synthetic_response(
+                    ec2_proxy.INVALID_REQUEST_ERROR_CODE, 400, f'{type(e).__name__}: {e}')
+                reached = False
+
+            if not reached:
+                breaker.cancel()
+            # Client errors (4xx) are user's fault - they do not open the circuit.
+            elif response['ResponseMetadata']['HTTPStatusCode'] >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
 
         request_id = response['ResponseMetadata']['RequestId']
 
-        self._requests.insert(
-            key=request_id,
-            value=response
-        )
+        if cache_response or response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            self._requests.insert(
+                key=request_id,
+                value=response
+            )
 
         response_status_code = response['ResponseMetadata']['HTTPStatusCode']
 
@@ -176,4 +700,12 @@ class ec2_proxy:
             LOGGER.error('%s failed with code %d / request_id: "%s"',
                          method_name, response_status_code, request_id)
 
-        return response, response_status_code
\ No newline at end of file
+        return response, response_status_code
+
+    @staticmethod
+    def _synthetic_response(error_code: str, status_code: int, message: str) -> dict:
+        """ Return error response in the format used by boto3. """
+        return {
+            'Error': {'Code': error_code, 'Message': message},
+            'ResponseMetadata': {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': status_code}
+        }
@@ -2,11 +2,13 @@
 
 import abc
 import errno
+import itertools
 import json
 import logging
 import os
 import stat
 import time
+import types
 import typing
 
 
@@ -20,33 +22,63 @@ LOGGER = logging.getLogger(__name__)
 class ec2fs(fuse.LoggingMixIn, fuse.Operations):
     """ ec2fs i a simple filesystem interface for AWS EC2 service. """
 
+    DOT_ENTRIES = ('.', '..')
+    AGE_XATTR = 'user.ec2fs.age'
+    UID = os.getuid()
+    GID = os.getgid()
+
     def __init__(self, ec2_proxy: 'ec2fs.ec2_proxy') -> None:
         self._ec2_proxy = ec2_proxy
 
+        self._fh_counter = itertools.count(1)
+        self._dir_handles = {}
+        # Data of file handles - snapshots of aggregated files taken on open
+        # and results of actions written on them - kept until release.
+        self._file_handles = {}
+
         flavors_data = '\n'.join(flavor for flavor in self._ec2_proxy.get_cached_flavors() if flavor)
         flavors_data = flavors_data.encode()
 
         #LOGGER.critical('flavors: %r', flavors_data)
 
-        flavors_attrs = ec2fs._file_attrs_factory()
-        flavors_attrs['st_size'] = len(flavors_data)
+        flavors_attrs = ec2fs._file_attrs_factory(st_size=len(flavors_data))
 
         self._fh = {
             '/': {
-                'attrs': ec2fs._dir_attrs_factory(),
-                'files': ['instances', 'images', 'requests', 'flavors', 'actions', 'refresh'],
+                'attrs': ec2fs._dir_attrs_factory(st_nlink=7, st_size=9),
+                'files': ('actions', 'flavors', 'images', 'images.ndjson', 'instances',
+                          'instances.ndjson', 'refresh', 'requests', 'tables'),
             },
             '/instances': {
                 'attrs': ec2fs._dir_attrs_factory(),
-                'files_callback': lambda: list(self._ec2_proxy.get_cached_instances().keys())
+                'files_callback': self._ec2_proxy.get_cached_instance_ids
             },
             '/images': {
                 'attrs': ec2fs._dir_attrs_factory(),
-                'files_callback': lambda: list(self._ec2_proxy.get_cached_images().keys())
+                'files_callback': self._ec2_proxy.get_cached_image_ids
             },
             '/requests': {
                 'attrs': ec2fs._dir_attrs_factory(),
-                'files_callback': lambda: list(self._ec2_proxy.get_cached_requests().keys())
+                'files_callback': self._ec2_proxy.get_cached_request_ids
+            },
+            '/instances.ndjson': {
+                'attrs': ec2fs._file_attrs_factory(),
+                'raw_data_callback': self._ec2_proxy.get_cached_instances_ndjson,
+                'write_callback': None
+            },
+            '/images.ndjson': {
+                'attrs': ec2fs._file_attrs_factory(),
+                'raw_data_callback': self._ec2_proxy.get_cached_images_ndjson,
+                'write_callback': None
+            },
+            '/tables': {
+                'attrs': ec2fs._dir_attrs_factory(st_size=1),
+                'files': ('instances.csv',)
+            },
+            '/tables/instances.csv': {
+                'attrs': ec2fs._file_attrs_factory(),
+                'raw_data_callback': self._ec2_proxy.get_cached_instances_csv,
+                'write_callback': None
             },
             '/flavors': {
                 'attrs': flavors_attrs,
@@ -54,71 +86,175 @@ class ec2fs(fuse.LoggingMixIn, fuse.Operations):
                 'write_callback': None
             },
             '/actions': {
-                'attrs': ec2fs._dir_attrs_factory(),
-                'files': ['run_instances', 'describe_instances', 'terminate_instances', 'describe_images']
+                'attrs': ec2fs._dir_attrs_factory(st_size=4),
+                'files': ('describe_images', 'describe_instances', 'run_instances', 'terminate_instances')
             },
             '/actions/run_instances': {
                 'attrs': ec2fs._file_attrs_factory(),
                 'raw_data': b'',
-                'write_callback': lambda d: self._ec2_proxy.run_instances(**d)
+                'write_callback': self._ec2_proxy.run_instances
             },
             '/actions/describe_instances': {
                 'attrs': ec2fs._file_attrs_factory(),
                 'raw_data': b'',
-                'write_callback': lambda d: self._ec2_proxy.describe_instances(**d)
+                'write_callback': self._ec2_proxy.describe_instances
             },
             '/actions/terminate_instances': {
                 'attrs': ec2fs._file_attrs_factory(),
                 'raw_data': b'',
-                'write_callback': lambda d: self._ec2_proxy.terminate_instances(**d)
+                'write_callback': self._ec2_proxy.terminate_instances
             },
             '/actions/describe_images': {
                 'attrs': ec2fs._file_attrs_factory(),
                 'raw_data': b'',
-                'write_callback': lambda d: self._ec2_proxy.describe_images(**d)
+                'write_callback': self._ec2_proxy.describe_images
             },
             '/refresh': {
                 'attrs': ec2fs._file_attrs_factory(),
                 'raw_data': b'',
-                'write_callback': lambda: self._ec2_proxy.describe_instances()
+                'write_callback': self._ec2_proxy.refresh_instances
             }
         }
 
-    def getattr(self, path: str, fh: int = None) -> dict:
+        # Files in these directories are resources - they are looked up by basename.
+        self._resource_routes = {
+            '/instances': self._ec2_proxy.lookup_instance,
+            '/images': self._ec2_proxy.lookup_image,
+            '/requests': self._ec2_proxy.get_cached_request
+        }
+
+    def init(self, path: str) -> None:
+        # Background threads have to be started here - not in __init__,
+        # since FUSE might daemonize the process after fs object is created.
+        self._ec2_proxy.start()
+
+    def destroy(self, path: str) -> None:
+        self._ec2_proxy.stop()
+
+    def getattr(self, path: str, fh: int = None) -> typing.Mapping[str, typing.Any]:
         LOGGER.debug('getattr: %r', path)
+        entry = self._fh.get(path)
+        if entry is not None:
+            handle = self._file_handles.get(fh)
+            if handle and handle['data'] is not None:
+                # File handle with its own data - its size is the size of the data.
+                return dict(entry['attrs'], st_size=len(handle['data']))
+            elif 'files_callback' in entry:
+                # Directory size is the number of its entries.
+                return dict(entry['attrs'], st_size=len(entry['files_callback']()))
+            elif 'raw_data_callback' in entry:
+                return dict(entry['attrs'], st_size=len(entry['raw_data_callback']()))
+            return entry['attrs']
+
         resource = self._get_resource(path)
         if resource:
-            resource_attrs = ec2fs._file_attrs_factory()
-            resource_attrs['st_size'] = resource['metadata']['size']
-            resource_attrs['st_ctime'] = resource['metadata']['@timestamp']
-            resource_attrs['st_mtime'] = resource['metadata']['@timestamp']
-            resource_attrs['st_atime'] = resource['metadata']['@timestamp']
-            return resource_attrs
-        elif path in self._fh:
-            return self._fh[path]['attrs']
-        else:
+            return ec2fs._resource_attrs(resource)
+        raise fuse.FuseOSError(errno.ENOENT)
+
+    def getxattr(self, path: str, name: str, position: int = 0) -> bytes:
+        resource = self._get_resource(path)
+        if resource and name == ec2fs.AGE_XATTR:
+            # Age (in seconds) of cached data - stale resources are returned
+            # as they are, but they are refreshed in background.
+            age = time.time() - resource['metadata']['@updated_timestamp']
+            return f'{age:.3f}'.encode()
+        raise fuse.FuseOSError(errno.ENODATA)
+
+    def listxattr(self, path: str) -> typing.List[str]:
+        if self._get_resource(path):
+            return [ec2fs.AGE_XATTR]
+        return []
+
+    def opendir(self, path: str) -> int:
+        LOGGER.debug('opendir: %r', path)
+        if path not in self._fh:
             raise fuse.FuseOSError(errno.ENOENT)
+        fh = next(self._fh_counter)
+        self._dir_handles[fh] = self._dir_handle_factory(path)
+        return fh
 
-    def readdir(self, path: str, fh: int) -> typing.List[str]:
+    def readdir(self, path: str, fh: int,
+                offset: int = 0) -> typing.Iterator[typing.Tuple[str, None, int]]:
         LOGGER.debug('readdir: %r', path)
-        if 'files_callback' in self._fh[path]:
-            return ['.', '..'] + self._fh[path]['files_callback']()
-        else:
-            return ['.', '..'] + self._fh[path]['files']
+        handle = self._dir_handles.get(fh) or self._dir_handle_factory(path)
+
+        # Listing starts at the offset requested by the kernel (see fuse_mount),
+        # every entry carries the offset of the next one - so the kernel can
+        # resume listing after its buffer is full, rewind or seek the directory.
+        #
+        # Entries are the sorted keys snapshot taken by opendir (it's computed
+        # once per store generation) - listing does not copy the store.
+        files = handle['files']
+        return ((ec2fs.DOT_ENTRIES[i] if i < 2 else files[i - 2], None, i + 1)
+                for i in range(offset, len(files) + 2))
+
+    def releasedir(self, path: str, fh: int) -> None:
+        self._dir_handles.pop(fh, None)
+
+    def open(self, path: str, flags: int) -> int:
+        LOGGER.debug('open: %r', path)
+        fh = next(self._fh_counter)
+        entry = self._fh.get(path)
+        if entry is not None and entry.get('write_callback'):
+            self._file_handles[fh] = {'data': None}
+        elif entry is not None and 'raw_data_callback' in entry:
+            # Aggregated file is pinned to the handle, so sequential reads
+            # do not mix versions of the file when the cache changes.
+            self._file_handles[fh] = {'data': entry['raw_data_callback']()}
+        return fh
+
+    def direct_io(self, path: str) -> bool:
+        """ Return True if file should bypass the page cache - data of its file handles
+            (see open) differ between handles, while the page cache is shared.
+        """
+        entry = self._fh.get(path)
+        return entry is not None and ('raw_data_callback' in entry or
+                                      bool(entry.get('write_callback')))
+
+    def release(self, path: str, fh: int) -> None:
+        self._file_handles.pop(fh, None)
 
     def read(self, path: str, size: int, offset: int, fh: int) -> bytes:
         LOGGER.debug('read: %r', path)
-        resource = self._get_resource(path)
-        if resource:
-            return resource['raw_data'][offset:offset+size]
+        entry = self._fh.get(path)
+        handle = self._file_handles.get(fh)
+        if handle and handle['data'] is not None:
+            # Snapshot of aggregated file or result of the action written on this handle.
+            return handle['data'][offset:offset+size]
+        elif entry is None:
+            resource = self._get_resource(path)
+            if not resource:
+                raise fuse.FuseOSError(errno.ENOENT)
+            # Raw data of shared cache entries is a memoryview of the mapped snapshot.
+            return bytes(resource['raw_data'][offset:offset+size])
+        elif 'raw_data_callback' in entry:
+            # Aggregated files are built once per cache generation.
+            return entry['raw_data_callback']()[offset:offset+size]
         else:
-            return self._fh[path]['raw_data'][offset:offset+size]
+            return entry['raw_data'][offset:offset+size]
 
     def write(self, path: str, data: bytes, offset: int, fh: int) -> int:
         LOGGER.debug('write: %r', path)
         write_callback = self._fh[path]['write_callback']
         if write_callback:
-            write_callback(json.loads(data))
+            try:
+                response = write_callback(**json.loads(data))
+            except (ValueError, TypeError) as e:
+                # Payload is not a JSON object or it has unexpected keys.
+                response = self._ec2_proxy.reject_request(f'{type(e).__name__}: {e}')
+            handle = self._file_handles.get(fh)
+            if handle is not None:
+                handle['data'] = json.dumps(response, default=str).encode()
+            # No response from the API - fail instead of pretending it worked.
+            error_code = response.get('Error', {}).get('Code')
+            if error_code == self._ec2_proxy.CIRCUIT_OPEN_ERROR_CODE:
+                raise fuse.FuseOSError(errno.EAGAIN)
+            elif error_code == self._ec2_proxy.ENDPOINT_ERROR_CODE:
+                raise fuse.FuseOSError(errno.EIO)
+            elif error_code == self._ec2_proxy.INVALID_REQUEST_ERROR_CODE:
+                raise fuse.FuseOSError(errno.EINVAL)
+            elif error_code == self._ec2_proxy.READ_ONLY_ERROR_CODE:
+                raise fuse.FuseOSError(errno.EROFS)
         else:
             LOGGER.warning('Writing to "%s" has no effect.', path)
         return len(data)
@@ -126,23 +262,45 @@ class ec2fs(fuse.LoggingMixIn, fuse.Operations):
     def truncate(self, path: str, length: int, fh: int = None) -> None:
         pass
 
+    def _dir_handle_factory(self, path: str) -> dict:
+        if 'files_callback' in self._fh[path]:
+            files = self._fh[path]['files_callback']()
+        else:
+            files = self._fh[path]['files']
+        return {'files': files}
+
     def _get_resource(self, path: str) -> typing.Optional[dict]:
-        dirname, basename = os.path.split(path)
+        dirname, _, basename = path.rpartition('/')
+        lookup = self._resource_routes.get(dirname)
+        if lookup is None:
+            return None
         try:
-            if dirname == '/instances':
-                return self._ec2_proxy.get_cached_instance(basename)
-            elif dirname == '/images':
-                return self._ec2_proxy.get_cached_image(basename)
-            elif dirname == '/requests':
-                return self._ec2_proxy.get_cached_request(basename)
-            else:
-                return None
+            return lookup(basename)
         except KeyError:
             LOGGER.error('File missing from cache: %s', path)
             raise fuse.FuseOSError(errno.ENOENT)
 
     @staticmethod
-    def _attrs_factory(st_mode: int, st_nlink: int, st_size: int) -> dict:
+    def _resource_attrs(resource: dict) -> typing.Mapping[str, typing.Any]:
+        """ Return attributes of resource - they are created once per resource change
+            and kept in its 'derived' dict (which is replaced when resource changes).
+        """
+        derived = resource['derived']
+        attrs = derived.get('attrs')
+        if attrs is None:
+            metadata = resource['metadata']
+            attrs = ec2fs._file_attrs_factory(
+                st_size=metadata['size'],
+                st_ctime=metadata['@timestamp'],
+                st_mtime=metadata['@updated_timestamp'],
+                st_atime=metadata['@updated_timestamp'])
+            derived['attrs'] = attrs
+        return attrs
+
+    @staticmethod
+    def _attrs_factory(st_mode: int, st_nlink: int, st_size: int,
+                       **kwargs) -> typing.Mapping[str, typing.Any]:
+        """ Return read-only attributes - they are shared between calls. """
         now = time.time()
         attrs = {
             'st_mode': st_mode,
@@ -151,23 +309,26 @@ class ec2fs(fuse.LoggingMixIn, fuse.Operations):
             'st_ctime': now,
             'st_mtime': now,
             'st_atime': now,
-            'st_uid': os.getuid(),
-            'st_gid': os.getgid()
+            'st_uid': ec2fs.UID,
+            'st_gid': ec2fs.GID
         }
-        return attrs
+        attrs.update(kwargs)
+        return types.MappingProxyType(attrs)
 
     @staticmethod
-    def _dir_attrs_factory():
+    def _dir_attrs_factory(st_nlink: int = 2, st_size: int = 0, **kwargs):
         return ec2fs._attrs_factory(
             st_mode=stat.S_IFDIR | 0o755,
-            st_nlink=2,
-            st_size=4096
+            st_nlink=st_nlink,
+            st_size=st_size,
+            **kwargs
         )
 
     @staticmethod
-    def _file_attrs_factory():
+    def _file_attrs_factory(st_size: int = 0, **kwargs):
         return ec2fs._attrs_factory(
             st_mode=stat.S_IFREG| 0o755,
             st_nlink=1,
-            st_size=0
-        )
\ No newline at end of file
+            st_size=st_size,
+            **kwargs
+        )
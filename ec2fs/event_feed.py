@@ -0,0 +1,138 @@
+""" This module contains event_feed class. """
+
+
+import datetime
+import json
+import logging
+import os
+import threading
+import typing
+
+
+import expiringdict
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class event_feed:
+    """ This class tails NDJSON spool file with EC2 instance state-change events
+        and applies them to the ec2_proxy cache - so the cache is updated without polling.
+
+        Events are expected in the format used by EventBridge, e.g.:
+
+            {"id": "7bf73129-1428-4cd3-a780-95db273d1602",
+             "detail-type": "EC2 Instance State-change Notification",
+             "time": "2020-06-20T12:00:00Z",
+             "detail": {"instance-id": "i-1234567890abcdef0", "state": "stopped"}}
+
+        Duplicated events (with the same id) are ignored, events are applied in
+        order of their time - events older than already applied ones are ignored.
+    """
+
+    POLL_INTERVAL = 0.2
+    SEEN_EVENTS_LIMITS = {'max_len': 100000, 'max_age_seconds': 3600}
+
+    def __init__(self, ec2_proxy: 'ec2fs.ec2_proxy', spool_path: str) -> None:
+        self._ec2_proxy = ec2_proxy
+        self._spool_path = spool_path
+
+        self._fh = None
+        self._inode = None
+        self._partial_line = b''
+
+        # Event ids are not kept for ever - events are not redelivered after
+        # an hour anyway, so there is no need to remember them any longer.
+        self._seen_events = expiringdict.ExpiringDict(**event_feed.SEEN_EVENTS_LIMITS)
+        self._last_event_times = {}
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """ Start tailing the spool file in background thread. """
+        if not self._thread:
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='event_feed', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """ Stop tailing the spool file. """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def process(self) -> int:
+        """ Apply events appended to the spool file since last call
+            and return the number of applied events.
+        """
+        events = []
+        for line in self._read_lines():
+            try:
+                event = json.loads(line)
+                events.append((
+                    event_feed._parse_time(event['time']),
+                    event.get('id'),
+                    event['detail']['instance-id'],
+                    event['detail']['state']))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                LOGGER.warning('Skipping malformed event: %r', line)
+
+        states = {}
+        for event_time, event_id, instance_id, state in sorted(events, key=lambda e: e[0]):
+            if event_id is not None:
+                if event_id in self._seen_events:
+                    continue
+                self._seen_events[event_id] = True
+            last_event_time = self._last_event_times.get(instance_id)
+            if last_event_time is not None and event_time < last_event_time:
+                LOGGER.debug('Skipping out of order event for "%s"', instance_id)
+                continue
+            self._last_event_times[instance_id] = event_time
+            states[instance_id] = state
+
+        if states:
+            self._ec2_proxy.apply_instance_states(states)
+
+        return len(states)
+
+    def _run(self) -> None:
+        """ Process the spool file every event_feed.POLL_INTERVAL seconds until stopped. """
+        while not self._stop_event.is_set():
+            try:
+                self.process()
+            except Exception:
+                LOGGER.exception('Failed to process events from "%s"', self._spool_path)
+            self._stop_event.wait(event_feed.POLL_INTERVAL)
+
+    def _read_lines(self) -> typing.List[bytes]:
+        """ Return complete lines appended to the spool file since last call
+            (the file is reopened if it was rotated or truncated).
+        """
+        try:
+            stat_result = os.stat(self._spool_path)
+        except FileNotFoundError:
+            return []
+
+        if (self._fh is None or self._inode != stat_result.st_ino or
+                stat_result.st_size < self._fh.tell()):
+            if self._fh is not None:
+                self._fh.close()
+            self._fh = open(self._spool_path, 'rb')
+            self._inode = stat_result.st_ino
+            self._partial_line = b''
+
+        lines = (self._partial_line + self._fh.read()).split(b'\n')
+        self._partial_line = lines.pop()
+
+        return [line for line in lines if line.strip()]
+
+    @staticmethod
+    def _parse_time(value: str) -> datetime.datetime:
+        """ Parse ISO 8601 time of the event ("Z" suffix is not supported by fromisoformat). """
+        event_time = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if event_time.tzinfo is None:
+            event_time = event_time.replace(tzinfo=datetime.timezone.utc)
+        return event_time
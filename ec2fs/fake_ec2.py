@@ -0,0 +1,331 @@
+""" This module contains fake_ec2 class. """
+
+
+import datetime
+import random
+import threading
+import time
+import typing
+import uuid
+
+
+from botocore.exceptions import ClientError
+
+
+class fake_ec2:
+    """ This class is a fast in-process fake of boto3 ec2 client - it can be passed
+        to ec2_proxy as its backend.
+
+        It generates fleet of instances and catalog of images of given sizes and
+        implements (a subset of) calls used by ec2_proxy, including pagination.
+        It's meant for benchmarks and soak tests, so it can also:
+
+            - delay every call by `latency` seconds,
+            - fail `throttling_rate` fraction of calls with RequestLimitExceeded,
+            - move instances through transitional states (pending -> running,
+              stopping -> stopped, shutting-down -> terminated) after `transition_time`
+              seconds, and change states of random instances with change_states.
+
+        Everything random is driven by `seed`, so scenarios are repeatable.
+    """
+
+    INSTANCE_TYPES = ('t2.nano', 't2.micro', 't2.small', 'm5.large', 'c5.xlarge')
+    AVAILABILITY_ZONES = ('us-east-2a', 'us-east-2b', 'us-east-2c')
+    STATE_CODES = {
+        'pending': 0,
+        'running': 16,
+        'shutting-down': 32,
+        'terminated': 48,
+        'stopping': 64,
+        'stopped': 80
+    }
+    TRANSITIONS = {'pending': 'running', 'stopping': 'stopped', 'shutting-down': 'terminated'}
+
+    def __init__(self, instances_count: int = 0, images_count: int = 1, latency: float = 0,
+                 throttling_rate: float = 0, transition_time: float = 0, seed: int = 0) -> None:
+        self._latency = latency
+        self._throttling_rate = throttling_rate
+        self._transition_time = transition_time
+        self._random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self._images = {}
+        self._instances = {}
+        # Instances in transitional states: instance_id -> time of the transition.
+        self._transitions = {}
+        self._sorted_ids = {}
+
+        for _ in range(images_count):
+            image = self._image_factory()
+            self._images[image['ImageId']] = image
+
+        image_ids = sorted(self._images)
+        reservation_id = self._random_id('r-')
+        for i in range(instances_count):
+            if i % 100 == 0:
+                reservation_id = self._random_id('r-')
+            instance = self._instance_factory(
+                self._random.choice(image_ids) if image_ids else self._random_id('ami-', 8),
+                self._random.choice(fake_ec2.INSTANCE_TYPES),
+                reservation_id,
+                'running')
+            self._instances[instance['InstanceId']] = instance
+
+    def change_states(self, count: int) -> typing.List[str]:
+        """ Stop (or start) given number of random instances - as if it was done by someone
+            else - and return their ids.
+        """
+        with self._lock:
+            self._advance()
+            candidates = [instance_id for instance_id, instance in self._instances.items()
+                          if instance['State']['Name'] in ('running', 'stopped')]
+            instance_ids = self._random.sample(candidates, min(count, len(candidates)))
+            for instance_id in instance_ids:
+                if self._instances[instance_id]['State']['Name'] == 'running':
+                    self._set_state(instance_id, 'stopping')
+                else:
+                    self._set_state(instance_id, 'pending')
+            return instance_ids
+
+    def run_instances(self, ImageId: str, MinCount: int, MaxCount: int,
+                      InstanceType: str = 'm1.small', **kwargs) -> dict:
+        self._simulate('RunInstances')
+        with self._lock:
+            reservation_id = self._random_id('r-')
+            instances = []
+            for _ in range(MaxCount):
+                instance = self._instance_factory(ImageId, InstanceType, reservation_id, 'pending')
+                self._instances[instance['InstanceId']] = instance
+                self._set_state(instance['InstanceId'], 'pending')
+                instances.append(fake_ec2._copy_instance(instance))
+            return self._response(
+                ReservationId=reservation_id,
+                OwnerId='123456789012',
+                Groups=[],
+                Instances=instances)
+
+    def describe_instances(self, InstanceIds: typing.List[str] = None,
+                           Filters: typing.List[dict] = None, MaxResults: int = None,
+                           NextToken: str = None, **kwargs) -> dict:
+        self._simulate('DescribeInstances')
+        with self._lock:
+            self._advance()
+            instances = self._select(self._instances, InstanceIds, Filters, 'instance-id',
+                                     'InvalidInstanceID.NotFound')
+            page, next_token = fake_ec2._paginate(instances, MaxResults, NextToken)
+
+            reservations = {}
+            for instance_id in page:
+                instance = self._instances[instance_id]
+                reservation = reservations.setdefault(instance['_ReservationId'], {
+                    'ReservationId': instance['_ReservationId'],
+                    'OwnerId': '123456789012',
+                    'Groups': [],
+                    'Instances': []
+                })
+                reservation['Instances'].append(fake_ec2._copy_instance(instance))
+
+            response = self._response(Reservations=list(reservations.values()))
+            if next_token:
+                response['NextToken'] = next_token
+            return response
+
+    def describe_instance_status(self, InstanceIds: typing.List[str] = None,
+                                 IncludeAllInstances: bool = False, MaxResults: int = None,
+                                 NextToken: str = None, **kwargs) -> dict:
+        self._simulate('DescribeInstanceStatus')
+        with self._lock:
+            self._advance()
+            instances = self._select(self._instances, InstanceIds, None, None,
+                                     'InvalidInstanceID.NotFound')
+            if not IncludeAllInstances:
+                instances = [instance_id for instance_id in instances
+                             if self._instances[instance_id]['State']['Name'] == 'running']
+            page, next_token = fake_ec2._paginate(instances, MaxResults, NextToken)
+
+            response = self._response(InstanceStatuses=[{
+                'InstanceId': instance_id,
+                'AvailabilityZone': self._instances[instance_id]['Placement']['AvailabilityZone'],
+                'InstanceState': dict(self._instances[instance_id]['State']),
+                'InstanceStatus': {'Status': 'ok'},
+                'SystemStatus': {'Status': 'ok'}
+            } for instance_id in page])
+            if next_token:
+                response['NextToken'] = next_token
+            return response
+
+    def terminate_instances(self, InstanceIds: typing.List[str], **kwargs) -> dict:
+        self._simulate('TerminateInstances')
+        with self._lock:
+            self._advance()
+            self._select(self._instances, InstanceIds, None, None, 'InvalidInstanceID.NotFound')
+            terminating = []
+            for instance_id in InstanceIds:
+                previous_state = dict(self._instances[instance_id]['State'])
+                if previous_state['Name'] != 'terminated':
+                    self._set_state(instance_id, 'shutting-down')
+                    self._instances[instance_id]['StateReason'] = {
+                        'Code': 'Client.UserInitiatedShutdown',
+                        'Message': 'Client.UserInitiatedShutdown: User initiated shutdown'
+                    }
+                terminating.append({
+                    'InstanceId': instance_id,
+                    'CurrentState': dict(self._instances[instance_id]['State']),
+                    'PreviousState': previous_state
+                })
+            return self._response(TerminatingInstances=terminating)
+
+    def describe_images(self, ImageIds: typing.List[str] = None,
+                        Filters: typing.List[dict] = None, MaxResults: int = None,
+                        NextToken: str = None, **kwargs) -> dict:
+        self._simulate('DescribeImages')
+        with self._lock:
+            images = self._select(self._images, ImageIds, Filters, 'image-id',
+                                  'InvalidAMIID.NotFound')
+            page, next_token = fake_ec2._paginate(images, MaxResults, NextToken)
+            response = self._response(Images=[dict(self._images[image_id]) for image_id in page])
+            if next_token:
+                response['NextToken'] = next_token
+            return response
+
+    def _simulate(self, operation_name: str) -> None:
+        """ Delay the call and throttle it (if it's drawn). """
+        if self._latency:
+            time.sleep(self._latency)
+        with self._lock:
+            throttled = self._throttling_rate and self._random.random() < self._throttling_rate
+        if throttled:
+            raise fake_ec2._client_error(operation_name, 'RequestLimitExceeded',
+                                         'Request limit exceeded.', 503)
+
+    def _select(self, resources: dict, ids: typing.Optional[typing.List[str]],
+                filters: typing.Optional[typing.List[dict]], id_filter_name: typing.Optional[str],
+                not_found_code: str) -> typing.List[str]:
+        """ Return sorted ids of resources matching ids and filters (like the API,
+            unknown ids fail the call, while unknown ids in filters are ignored).
+
+            Filters which are not supported fail the call - ignoring them would
+            return more resources than the API does.
+        """
+        if ids:
+            missing_ids = [resource_id for resource_id in ids if resource_id not in resources]
+            if missing_ids:
+                raise fake_ec2._client_error(
+                    'Describe', not_found_code,
+                    f"The ID '{', '.join(missing_ids)}' does not exist", 400)
+            selected = set(ids)
+        else:
+            selected = None
+
+        for resource_filter in filters or []:
+            values = set(resource_filter['Values'])
+            if resource_filter['Name'] == id_filter_name:
+                matching = set(resource_id for resource_id in values if resource_id in resources)
+            elif resource_filter['Name'] == 'instance-state-name' and resources is self._instances:
+                matching = set(resource_id for resource_id, resource in resources.items()
+                               if resource['State']['Name'] in values)
+            else:
+                raise fake_ec2._client_error(
+                    'Describe', 'InvalidParameterValue',
+                    f"The filter '{resource_filter['Name']}' is not supported by fake_ec2", 400)
+            selected = matching if selected is None else selected & matching
+
+        if selected is None:
+            # Resources are never removed, so sorted ids change only with their number.
+            count, ids = self._sorted_ids.get(id(resources), (None, None))
+            if count != len(resources):
+                ids = sorted(resources)
+                self._sorted_ids[id(resources)] = (len(resources), ids)
+            return ids
+        return sorted(selected)
+
+    def _advance(self) -> None:
+        """ Move instances whose transition time passed to their next state. """
+        if not self._transitions:
+            return
+        now = time.time()
+        for instance_id, transition_time in list(self._transitions.items()):
+            if transition_time <= now:
+                state = self._instances[instance_id]['State']['Name']
+                self._set_state(instance_id, fake_ec2.TRANSITIONS[state])
+
+    def _set_state(self, instance_id: str, state: str) -> None:
+        """ Set state of instance (and schedule its transition if it's transitional). """
+        self._instances[instance_id]['State'] = {'Code': fake_ec2.STATE_CODES[state], 'Name': state}
+        if state in fake_ec2.TRANSITIONS:
+            self._transitions[instance_id] = time.time() + self._transition_time
+        else:
+            self._transitions.pop(instance_id, None)
+
+    def _image_factory(self) -> dict:
+        image_id = self._random_id('ami-', 8)
+        return {
+            'ImageId': image_id,
+            'ImageLocation': f'amazon/{image_id}',
+            'Name': f'fake-image-{image_id}',
+            'Architecture': 'x86_64',
+            'ImageType': 'machine',
+            'OwnerId': '123456789012',
+            'Public': True,
+            'RootDeviceType': 'ebs',
+            'State': 'available',
+            'VirtualizationType': 'hvm',
+            'CreationDate': '2020-01-01T00:00:00.000Z'
+        }
+
+    def _instance_factory(self, image_id: str, instance_type: str,
+                          reservation_id: str, state: str) -> dict:
+        availability_zone = self._random.choice(fake_ec2.AVAILABILITY_ZONES)
+        private_ip = '10.{}.{}.{}'.format(*(self._random.randrange(256) for _ in range(3)))
+        return {
+            'InstanceId': self._random_id('i-'),
+            'ImageId': image_id,
+            'InstanceType': instance_type,
+            'State': {'Code': fake_ec2.STATE_CODES[state], 'Name': state},
+            'LaunchTime': datetime.datetime.now(datetime.timezone.utc),
+            'Placement': {'AvailabilityZone': availability_zone, 'Tenancy': 'default'},
+            'PrivateIpAddress': private_ip,
+            'PrivateDnsName': f"ip-{private_ip.replace('.', '-')}.ec2.internal",
+            'PublicIpAddress': '3.{}.{}.{}'.format(*(self._random.randrange(256) for _ in range(3))),
+            'VpcId': 'vpc-12345678',
+            'SubnetId': f'subnet-{availability_zone[-1] * 8}',
+            'Architecture': 'x86_64',
+            'Tags': [{'Key': 'Name', 'Value': f'fake-{instance_type}'}],
+            '_ReservationId': reservation_id
+        }
+
+    def _random_id(self, prefix: str, length: int = 17) -> str:
+        return prefix + ''.join(self._random.choice('0123456789abcdef') for _ in range(length))
+
+    def _response(self, **kwargs) -> dict:
+        kwargs['ResponseMetadata'] = {
+            'RequestId': str(uuid.UUID(int=self._random.getrandbits(128))),
+            'HTTPStatusCode': 200
+        }
+        return kwargs
+
+    @staticmethod
+    def _copy_instance(instance: dict) -> dict:
+        """ Return copy of instance as returned by the API - fields modified
+            by the fake (states) are copied, so cached copies are not affected.
+        """
+        copy = {key: value for key, value in instance.items() if key != '_ReservationId'}
+        copy['State'] = dict(instance['State'])
+        return copy
+
+    @staticmethod
+    def _paginate(ids: typing.List[str], max_results: typing.Optional[int],
+                  next_token: typing.Optional[str]) -> typing.Tuple[typing.List[str], typing.Optional[str]]:
+        """ Return page of ids and token of the next one (tokens are offsets). """
+        start = int(next_token) if next_token else 0
+        if not max_results:
+            return ids[start:], None
+        end = start + max_results
+        return ids[start:end], (str(end) if end < len(ids) else None)
+
+    @staticmethod
+    def _client_error(operation_name: str, code: str, message: str, status_code: int) -> ClientError:
+        return ClientError({
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': status_code}
+        }, operation_name)
@@ -0,0 +1,26 @@
+""" This module contains fuse_mount class. """
+
+
+import fuse
+
+
+class fuse_mount(fuse.FUSE):
+    """ This class mounts fuse.Operations like fuse.FUSE does, but it passes
+        to the operations what fusepy drops (without switching to raw_fi):
+
+            - offset requested by the kernel to readdir,
+            - direct_io flag of opened files (operations tell it with direct_io method).
+    """
+
+    def open(self, path, fip):
+        ret = super().open(path, fip)
+        fip.contents.direct_io = bool(self.operations('direct_io', path.decode(self.encoding)))
+        return ret
+
+    def readdir(self, path, buf, filler, offset, fip):
+        for name, attrs, next_offset in self.operations(
+                'readdir', self._decode_optional_path(path), fip.contents.fh, offset):
+            # Attributes are not passed - getattr is called for every entry anyway.
+            if filler(buf, name.encode(self.encoding), None, next_offset) != 0:
+                break
+        return 0
@@ -2,6 +2,7 @@
 
 
 import collections
+import copy
 import json
 import time
 import typing
@@ -16,9 +17,14 @@ class guarded_kv_store:
             might waste thread safety of this class.
     """
 
-    def __init__(self, dict_cls: typing.Type = dict) -> None:
+    def __init__(self, dict_cls: typing.Type = dict, volatile: bool = False) -> None:
         self._dict = dict_cls()
         self._guard = rwlock.RWLockWrite()
+        self._generation = 0
+        self._aggregates = {}
+        # Entries of volatile stores disappear on their own (e.g. with expiringdict)
+        # without changing the generation - aggregates are not cached then.
+        self._volatile = volatile
 
     def __len__(self) -> int:
         with self._guard.gen_rlock():
@@ -28,30 +34,70 @@ class guarded_kv_store:
         with self._guard.gen_rlock():
             return key in self._dict 
 
+    @property
+    def generation(self) -> int:
+        """ Number that changes every time the store is modified. """
+        return self._generation
+
+    def keys(self) -> typing.Tuple[typing.Hashable, ...]:
+        """ Get sorted keys - they are computed once per generation,
+            so (unlike bulk_get) repeated calls do not copy the store.
+        """
+        return self.aggregate('keys', lambda entries: tuple(sorted(entries)))
+
+    def aggregate(self, name: str, builder: typing.Callable[[dict], typing.Any]) -> typing.Any:
+        """ Get value built from all entries (key -> {data, raw_data, metadata}) by builder
+            - it's called once per generation, then the value is returned from cache.
+
+            Note that builder is called under read lock, so it must not access the store.
+        """
+        if self._volatile:
+            with self._guard.gen_rlock():
+                # items() skips entries that expired (iteration does not).
+                return builder(dict(self._dict.items()))
+
+        # Generation is bumped before the store is modified, so if it matches
+        # the cached one, the value is up to date and the lock can be skipped.
+        generation, value = self._aggregates.get(name, (None, None))
+        if generation == self._generation:
+            return value
+
+        with self._guard.gen_rlock():
+            generation, value = self._aggregates.get(name, (None, None))
+            if generation != self._generation:
+                value = builder(self._dict)
+                self._aggregates[name] = (self._generation, value)
+            return value
+
     def insert(self, key: typing.Hashable, value: dict) -> None:
         """ Add/Overwrite value of key. """
         with self._guard.gen_wlock():
+            self._generation += 1
             self._insert(key, value)
 
     def remove(self, key: typing.Hashable) -> None:
         """ Remove value of key. """
         with self._guard.gen_wlock():
+            self._generation += 1
             del self._dict[key]
 
     def get(self, key: typing.Hashable, default: typing.Any = None) -> dict:
         """ Get value of key or default if key does not exist. """
-        with self._guard.gen_rlock():
-            return self._dict.get(key, default)
+        # Single lookup is atomic, so the lock is not needed - and it's
+        # by far the most frequent call (every getattr of a resource).
+        return self._dict.get(key, default)
 
     def bulk_insert(self, entries: typing.List[typing.Tuple[typing.Hashable, typing.Any]]) -> None:
         """ Add/Overwrite given (key,value) entries. """ 
         with self._guard.gen_wlock():
+            self._generation += 1
             for key, value in entries:
                 self._insert(key, value)
 
     def bulk_remove(self, keys: typing.List[typing.Hashable], key_error_ok: bool = False) -> None:
         """ Remove valaues of given keys (ignore errors if `key_error_ok` specified). """ 
-        with self._guard.gen_rlock():
+        with self._guard.gen_wlock():
+            self._generation += 1
             for key in keys:
                 try:
                     del self._dict[key]
@@ -74,30 +120,47 @@ class guarded_kv_store:
             else:
                 return dict(self._dict)
 
-    def bulk_update(self, entries: typing.List[typing.Tuple[typing.Hashable, dict]]) -> None:
-        """ Assume inner structure is dict and update its values in bulk request. """
+    def bulk_update(self, entries: typing.List[typing.Tuple[typing.Hashable, dict]], key_error_ok: bool = False) -> typing.List[typing.Hashable]:
+        """ Assume inner structure is dict and update its values in bulk request
+            (ignore errors if `key_error_ok` specified, but return missing keys).
+        """
+        missing_keys = []
         with self._guard.gen_wlock():
+            self._generation += 1
             for key, value in entries:
-                self._update(self._dict[key], value)
+                try:
+                    data = self._dict[key]['data']
+                except KeyError:
+                    if not key_error_ok:
+                        raise
+                    missing_keys.append(key)
+                else:
+                    # Data of the current entry might be in use - it's updated in a copy.
+                    self._insert(key, self._update(copy.deepcopy(data), value))
+        return missing_keys
 
     def _insert(self, key: typing.Hashable, value: dict) -> None:
-        """ Insert/Overwrite given (key, value) entry nad setup timestamps. """
+        """ Insert/Overwrite given (key, value) entry nad setup timestamps.
+
+            Entries have also 'derived' dict - users of the store can cache there values
+            derived from the entry, since it's replaced whenever the entry changes.
+
+            Entry is replaced as a whole (never modified in place), so lock-free
+            readers see either the old entry or the new one.
+        """
         timestamp = time.time()
         raw_data = json.dumps(value, default=str).encode()
-        if key in self._dict:
-            self._dict[key]['data'] = value
-            self._dict[key]['raw_data'] = raw_data
-            self._dict[key]['metadata']['@updated_timestamp'] = timestamp
-            self._dict[key]['metadata']['size'] = len(raw_data)
-        else:
-            self._dict[key] = {
-                'data': value,
-                'raw_data': raw_data,
-                'metadata': {
-                    '@timestamp': timestamp,
-                    'size': len(raw_data)
-                }
-            }
+        old_entry = self._dict.get(key)
+        self._dict[key] = {
+            'data': value,
+            'raw_data': raw_data,
+            'metadata': {
+                '@timestamp': old_entry['metadata']['@timestamp'] if old_entry else timestamp,
+                '@updated_timestamp': timestamp,
+                'size': len(raw_data)
+            },
+            'derived': {}
+        }
 
     def _update(self, d, u):
         """ Update nested dict - taken from stackoverflow. """
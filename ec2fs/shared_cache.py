@@ -0,0 +1,317 @@
+""" This module contains shared_cache and shared_kv_view classes. """
+
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import typing
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class shared_cache:
+    """ This class shares cached resources between ec2fs processes on one host.
+
+        Only one process (the owner - the one that holds the lock file) refreshes
+        its cache and publishes it to the snapshot file. Other processes attach
+        to the snapshot with shared_kv_view, which maps the file into memory
+        - so they do not poll the API and they do not keep their own copies.
+
+        Snapshot file layout:
+
+            MAGIC | index offset (u64) | index length (u64) | raw data of entries | index
+
+        where index is JSON document:
+
+            {"stores": {name: {key: [offset, length, @timestamp, @updated_timestamp]}}}
+
+        Snapshot is written to temporary file and renamed, so readers never see
+        half-written snapshot.
+
+        When started by a process which is not the owner, it keeps trying to acquire
+        the lock file - once the owner exits, `on_acquire` callback is called (so the
+        process can register its stores) and the process becomes the owner.
+    """
+
+    MAGIC = b'EC2FSSC1'
+    HEADER = struct.Struct('<8sQQ')
+    PUBLISH_INTERVAL = 1
+
+    def __init__(self, path: str,
+                 on_acquire: typing.Optional[typing.Callable[['shared_cache'], None]] = None) -> None:
+        self._path = path
+        self._on_acquire = on_acquire
+        self._lock_fh = None
+
+        self._stores = {}
+        self._published_generations = {}
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def acquire(self) -> bool:
+        """ Try to become the owner of the shared cache - return True on success. """
+        # Lock file is opened read-only (flock does not need more), so mounts
+        # of other users can take over the lock file created by the owner.
+        try:
+            lock_fd = os.open(f'{self._path}.lock', os.O_RDONLY | os.O_CREAT, 0o644)
+        except PermissionError:
+            LOGGER.warning('Failed to open lock file of shared cache "%s"', self._path)
+            return False
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(lock_fd)
+            return False
+        self._lock_fh = os.fdopen(lock_fd, 'rb')
+        return True
+
+    def register_store(self, name: str, store: 'ec2fs.guarded_kv_store') -> None:
+        """ Register store which should be published by the owner. """
+        self._stores[name] = store
+
+    def view(self, name: str) -> 'shared_kv_view':
+        """ Return read-only view of the store published by the owner. """
+        return shared_kv_view(self._path, name)
+
+    @property
+    def owner(self) -> bool:
+        """ True if this process is the owner of the shared cache. """
+        return self._lock_fh is not None
+
+    def start(self) -> None:
+        """ Start publishing registered stores (or trying to become
+            the owner first) in background thread.
+        """
+        if not self._thread:
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='shared_cache', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """ Stop publishing registered stores and release the lock file,
+            so another process can take over.
+        """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._lock_fh:
+            self._lock_fh.close()
+            self._lock_fh = None
+
+    def publish(self) -> bool:
+        """ Write snapshot of registered stores if any of them changed
+            since the last call - return True if snapshot was written.
+        """
+        generations = {name: store.generation for name, store in self._stores.items()}
+        if generations == self._published_generations:
+            return False
+
+        # Temporary file is created exclusively with unpredictable name - the cache
+        # might live in world-writable directory (e.g. /dev/shm).
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._path)),
+                                            prefix=f'{os.path.basename(self._path)}.',
+                                            suffix='.tmp')
+        try:
+            index = {'stores': {}}
+            with os.fdopen(tmp_fd, 'wb') as fh:
+                fh.write(shared_cache.HEADER.pack(shared_cache.MAGIC, 0, 0))
+                for name, store in self._stores.items():
+                    entries = index['stores'][name] = {}
+                    for key, entry in store.bulk_get().items():
+                        raw_data, metadata = entry['raw_data'], entry['metadata']
+                        entries[key] = [fh.tell(), len(raw_data),
+                                        metadata['@timestamp'], metadata['@updated_timestamp']]
+                        fh.write(raw_data)
+                index_offset = fh.tell()
+                index_length = fh.write(json.dumps(index).encode())
+                fh.seek(0)
+                fh.write(shared_cache.HEADER.pack(shared_cache.MAGIC, index_offset, index_length))
+                os.fchmod(fh.fileno(), 0o644)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self._published_generations = generations
+        return True
+
+    def _run(self) -> None:
+        """ Publish (or try to become the owner) every shared_cache.PUBLISH_INTERVAL
+            seconds until stopped.
+        """
+        while not self._stop_event.is_set():
+            try:
+                if not self.owner and self.acquire():
+                    LOGGER.info('Took over shared cache "%s"', self._path)
+                    if self._on_acquire:
+                        self._on_acquire(self)
+                if self.owner:
+                    self.publish()
+            except Exception:
+                LOGGER.exception('Failed to publish shared cache to "%s"', self._path)
+            self._stop_event.wait(shared_cache.PUBLISH_INTERVAL)
+
+
+class _shared_entry(dict):
+    """ Entry of shared_kv_view - its data is parsed on first access. """
+
+    def __missing__(self, key: str) -> typing.Any:
+        if key != 'data':
+            raise KeyError(key)
+        self['data'] = json.loads(bytes(self['raw_data']))
+        return self['data']
+
+
+class shared_kv_view:
+    """ This class is read-only counterpart of guarded_kv_store backed by
+        the snapshot published with shared_cache.
+
+        Raw data of entries are memoryviews of the mapped snapshot (they are not copied),
+        snapshot is remapped at most every shared_kv_view.CHECK_INTERVAL seconds if
+        it was replaced. Modifications are ignored - the owner refreshes the cache.
+    """
+
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self, path: str, name: str) -> None:
+        self._path = path
+        self._name = name
+
+        self._lock = threading.Lock()
+        self._checked = None
+        self._file_id = None
+        # (generation, index, mapped snapshot, entries) - replaced as a whole on remap.
+        self._state = (0, {}, None, {})
+        self._aggregates = {}
+
+    def __len__(self) -> int:
+        return len(self._snapshot()[1])
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._snapshot()[1]
+
+    @property
+    def generation(self) -> int:
+        """ Number that changes every time the snapshot is remapped. """
+        return self._snapshot()[0]
+
+    def keys(self) -> typing.Tuple[typing.Hashable, ...]:
+        """ Get sorted keys - they are computed once per generation
+            (from the index, without creating entries).
+        """
+        state = self._snapshot()
+        generation, value = self._aggregates.get('keys', (None, None))
+        if generation != state[0]:
+            value = tuple(sorted(state[1]))
+            self._aggregates['keys'] = (state[0], value)
+        return value
+
+    def aggregate(self, name: str, builder: typing.Callable[[dict], typing.Any]) -> typing.Any:
+        """ Get value built from all entries by builder - it's called once per generation. """
+        state = self._snapshot()
+        generation, value = self._aggregates.get(name, (None, None))
+        if generation != state[0]:
+            value = builder({key: self._get(state, key) for key in state[1]})
+            self._aggregates[name] = (state[0], value)
+        return value
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> dict:
+        """ Get value of key or default if key does not exist. """
+        state = self._snapshot()
+        if key not in state[1]:
+            return default
+        return self._get(state, key)
+
+    def bulk_get(self, keys: typing.Optional[typing.List[typing.Hashable]] = None,
+                 key_error_ok: bool = False) -> typing.Dict[typing.Hashable, dict]:
+        """ Get values of given keys (ignore errors if `key_error_ok` specified). """
+        state = self._snapshot()
+        ret = {}
+        for key in keys or state[1]:
+            if key in state[1]:
+                ret[key] = self._get(state, key)
+            elif not key_error_ok:
+                raise KeyError(key)
+        return ret
+
+    def insert(self, key: typing.Hashable, value: dict) -> None:
+        """ Ignored - view is read-only. """
+
+    def remove(self, key: typing.Hashable) -> None:
+        """ Ignored - view is read-only. """
+
+    def bulk_insert(self, entries: typing.List[typing.Tuple[typing.Hashable, typing.Any]]) -> None:
+        """ Ignored - view is read-only. """
+
+    def bulk_remove(self, keys: typing.List[typing.Hashable], key_error_ok: bool = False) -> None:
+        """ Ignored - view is read-only. """
+
+    def bulk_update(self, entries: typing.List[typing.Tuple[typing.Hashable, dict]],
+                    key_error_ok: bool = False) -> typing.List[typing.Hashable]:
+        """ Ignored - view is read-only. """
+        return []
+
+    @staticmethod
+    def _get(state: tuple, key: typing.Hashable) -> dict:
+        """ Return entry of key (it's created on first access). """
+        _, index, view, entries = state
+        entry = entries.get(key)
+        if entry is None:
+            offset, length, timestamp, updated_timestamp = index[key]
+            entry = entries[key] = _shared_entry(
+                raw_data=view[offset:offset + length],
+                metadata={
+                    '@timestamp': timestamp,
+                    '@updated_timestamp': updated_timestamp,
+                    'size': length
+                },
+                derived={})
+        return entry
+
+    def _snapshot(self) -> tuple:
+        """ Return current state (remap the snapshot first if it was replaced). """
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < shared_kv_view.CHECK_INTERVAL:
+            return self._state
+
+        with self._lock:
+            if self._checked is None or now - self._checked >= shared_kv_view.CHECK_INTERVAL:
+                try:
+                    self._remap()
+                except FileNotFoundError:
+                    LOGGER.debug('Shared cache "%s" is not published yet', self._path)
+                except (OSError, ValueError) as e:
+                    LOGGER.warning('Failed to map shared cache "%s": %s', self._path, e)
+                self._checked = now
+        return self._state
+
+    def _remap(self) -> None:
+        """ Map the snapshot if it's not mapped yet or it was replaced. """
+        stat_result = os.stat(self._path)
+        file_id = (stat_result.st_ino, stat_result.st_mtime_ns)
+        if file_id == self._file_id:
+            return
+
+        with open(self._path, 'rb') as fh:
+            # Old mapping is not closed explicitly - entries that are still in use
+            # might reference it, it's released once they are gone.
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, index_offset, index_length = shared_cache.HEADER.unpack_from(mapping)
+        if magic != shared_cache.MAGIC:
+            raise ValueError('not a shared cache snapshot')
+        index = json.loads(mapping[index_offset:index_offset + index_length])
+
+        self._state = (self._state[0] + 1, index['stores'].get(self._name, {}),
+                       memoryview(mapping), {})
+        self._file_id = file_id
@@ -4,6 +4,10 @@
 import json
 
 
+from ec2fs import ec2_proxy
+from ec2fs import fake_ec2
+
+
 def test_run_instances(mocked_ec2fs, benchmark):
     def run_instances():
         with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as fh:
@@ -38,4 +42,14 @@ def test_describe_images(mocked_ec2fs, benchmark):
     def describe_images():
         with open(f'{mocked_ec2fs}/actions/describe_images', 'w') as fh:
             json.dump({}, fh)
-    benchmark.pedantic(describe_images, iterations=10, rounds=10)
\ No newline at end of file
+    benchmark.pedantic(describe_images, iterations=10, rounds=10)
+
+def test_delta_refresh_fake_fleet(benchmark):
+    backend = fake_ec2.fake_ec2(instances_count=10000)
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+    proxy.refresh_instances()
+
+    def refresh_instances():
+        backend.change_states(10)
+        proxy.refresh_instances()
+    benchmark.pedantic(refresh_instances, iterations=1, rounds=10)
@@ -0,0 +1,61 @@
+""" This module tests circuit_breaker class. """
+
+
+import time
+
+
+from ec2fs import circuit_breaker
+
+
+def test_circuit_breaker_opens_after_failures():
+    breaker = circuit_breaker.circuit_breaker(failure_threshold=3, reset_timeout=60)
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == circuit_breaker.circuit_breaker.CLOSED
+
+    # Success resets the count of consecutive failures.
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+
+    assert breaker.state == circuit_breaker.circuit_breaker.OPEN
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_half_open_probe():
+    breaker = circuit_breaker.circuit_breaker(failure_threshold=1, reset_timeout=0.1)
+
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.1)
+    assert breaker.state == circuit_breaker.circuit_breaker.HALF_OPEN
+    # Only single probe is allowed.
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # Failed probe opens the circuit again.
+    breaker.record_failure()
+    assert breaker.state == circuit_breaker.circuit_breaker.OPEN
+
+    time.sleep(0.1)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == circuit_breaker.circuit_breaker.CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_cancelled_probe():
+    breaker = circuit_breaker.circuit_breaker(failure_threshold=1, reset_timeout=0.1)
+
+    breaker.record_failure()
+    time.sleep(0.1)
+    assert breaker.allow()
+
+    # Probe that was not made lets another one through.
+    breaker.cancel()
+    assert breaker.state == circuit_breaker.circuit_breaker.HALF_OPEN
+    assert breaker.allow()
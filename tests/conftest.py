@@ -10,13 +10,13 @@ import threading
 
 
 import boto3
-import fuse
 import moto
 import pytest
 
 
 from ec2fs import ec2_proxy
 from ec2fs import ec2fs
+from ec2fs import fuse_mount
 
 
 LOGGER = logging.getLogger(__name__)
@@ -55,7 +55,7 @@ def mocked_ec2fs(mocked_ec2_proxy, mountpoint):
     if pid == 0:
         try:
             LOGGER.debug('FUSE started its work!')
-            fuse.FUSE(
+            fuse_mount.fuse_mount(
                 ec2fs.ec2fs(mocked_ec2_proxy),
                 str(mountpoint),
                 foreground=True,
@@ -2,6 +2,11 @@
 
 
 import logging
+import os
+import time
+
+
+from ec2fs import ec2_proxy, fake_ec2, shared_cache
 
 
 LOGGER = logging.getLogger(__name__)
@@ -118,4 +123,272 @@ def test_synchronization(ec2_mock, not_mocked_ec2_client, not_mocked_ec2_proxy):
     assert request_id in not_mocked_ec2_proxy.get_cached_requests()
     assert len(not_mocked_ec2_proxy.get_cached_instances()) == instances_len
 
-    ec2_mock.stop()
\ No newline at end of file
+    ec2_mock.stop()
+
+def test_refresh_instances(ec2_mock, not_mocked_ec2_client, not_mocked_ec2_proxy):
+    ec2_mock.start()
+
+    instances_len = 5
+
+    response = not_mocked_ec2_client.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': instances_len,
+        'MinCount': instances_len,
+        'ImageId': 'ami-03cf127a'
+    })
+
+    not_mocked_ec2_proxy.refresh_instances()
+
+    assert len(not_mocked_ec2_proxy.get_cached_instances()) == instances_len
+
+    instance_id = response['Instances'][0]['InstanceId']
+    not_mocked_ec2_client.stop_instances(InstanceIds=[instance_id])
+
+    # Second refresh is a delta one - only the stopped instance is re-described.
+    not_mocked_ec2_proxy.refresh_instances()
+
+    instance_metadata = not_mocked_ec2_proxy.get_cached_instance(instance_id)['data']
+
+    assert len(not_mocked_ec2_proxy.get_cached_instances()) == instances_len
+    assert 'stopped' == instance_metadata['State']['Name']
+
+    ec2_mock.stop()
+
+
+def test_get_cached_instances_csv(mocked_ec2_proxy):
+    mocked_ec2_proxy.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 2,
+        'MinCount': 2,
+        'ImageId': 'ami-03cf127a'
+    })
+
+    table = mocked_ec2_proxy.get_cached_instances_csv()
+
+    # Table is built once per cache generation.
+    assert table is mocked_ec2_proxy.get_cached_instances_csv()
+    assert len(table.splitlines()) == 3
+    assert table.startswith(b'InstanceId,InstanceType,State,')
+
+
+def test_lookup_instance(ec2_mock, not_mocked_ec2_client, not_mocked_ec2_proxy, monkeypatch):
+    ec2_mock.start()
+
+    response = not_mocked_ec2_client.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 1,
+        'MinCount': 1,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    assert not_mocked_ec2_proxy.get_cached_instance(instance_id) is None
+    assert not_mocked_ec2_proxy.lookup_instance(instance_id)['data']['InstanceId'] == instance_id
+
+    missing_instance_id = 'i-0123456789abcdef0'
+
+    assert not_mocked_ec2_proxy.lookup_instance(missing_instance_id) is None
+
+    calls = []
+    describe_instances = not_mocked_ec2_proxy._ec2.describe_instances
+    monkeypatch.setattr(not_mocked_ec2_proxy._ec2, 'describe_instances',
+                        lambda **kwargs: calls.append(kwargs) or describe_instances(**kwargs))
+
+    # Missing instance is remembered - no more requests are made.
+    assert not_mocked_ec2_proxy.lookup_instance(missing_instance_id) is None
+    assert calls == []
+
+    ec2_mock.stop()
+
+
+def test_stale_instance_revalidation(ec2_mock, not_mocked_ec2_client, not_mocked_ec2_proxy, monkeypatch):
+    ec2_mock.start()
+
+    monkeypatch.setitem(not_mocked_ec2_proxy.FRESHNESS_TTLS, 'instances', 0)
+
+    response = not_mocked_ec2_proxy.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 1,
+        'MinCount': 1,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    not_mocked_ec2_client.stop_instances(InstanceIds=[instance_id])
+
+    # Stale instance is returned at once (with the cached data) and described in background.
+    instance = not_mocked_ec2_proxy.lookup_instance(instance_id)
+    updated_timestamp = instance['metadata']['@updated_timestamp']
+
+    assert instance['data']['State']['Name'] in ('pending', 'running')
+
+    for _ in range(50):
+        instance = not_mocked_ec2_proxy.lookup_instance(instance_id)
+        if instance['data']['State']['Name'] == 'stopped':
+            break
+        time.sleep(0.1)
+
+    assert 'stopped' == instance['data']['State']['Name']
+    assert instance['metadata']['@updated_timestamp'] > updated_timestamp
+
+    ec2_mock.stop()
+
+
+def test_shared_cache(ec2_mock, tmpdir, monkeypatch):
+    ec2_mock.start()
+
+    monkeypatch.setattr(shared_cache.shared_kv_view, 'CHECK_INTERVAL', 0)
+
+    owner = ec2_proxy.ec2_proxy(shared_cache_path=f'{tmpdir}/cache')
+    reader = ec2_proxy.ec2_proxy(shared_cache_path=f'{tmpdir}/cache')
+
+    response = owner.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 2,
+        'MinCount': 2,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    assert len(reader.get_cached_instances()) == 0
+
+    owner.start()
+    for _ in range(50):
+        if len(reader.get_cached_instances()) == 2:
+            break
+        time.sleep(0.1)
+    owner.stop()
+
+    assert len(reader.get_cached_instances()) == 2
+    assert reader.lookup_instance(instance_id)['data']['InstanceId'] == instance_id
+
+    ec2_mock.stop()
+
+
+def test_shared_cache_read_only_lock_file(tmpdir):
+    # Lock file might be created by other user - it's not writable then.
+    with open(f'{tmpdir}/cache.lock', 'w'):
+        pass
+    os.chmod(f'{tmpdir}/cache.lock', 0o444)
+
+    owner = shared_cache.shared_cache(f'{tmpdir}/cache')
+    reader = shared_cache.shared_cache(f'{tmpdir}/cache')
+
+    assert owner.acquire()
+    assert not reader.acquire()
+
+
+def test_shared_cache_take_over(tmpdir, monkeypatch):
+    monkeypatch.setattr(shared_cache.shared_kv_view, 'CHECK_INTERVAL', 0)
+    monkeypatch.setattr(shared_cache.shared_cache, 'PUBLISH_INTERVAL', 0.1)
+
+    backend = fake_ec2.fake_ec2(instances_count=3)
+    owner = ec2_proxy.ec2_proxy(shared_cache_path=f'{tmpdir}/cache', backend=backend)
+    reader = ec2_proxy.ec2_proxy(shared_cache_path=f'{tmpdir}/cache', backend=backend)
+
+    owner.refresh_instances()
+    owner.start()
+    reader.start()
+    for _ in range(50):
+        if len(reader.get_cached_instance_ids()) == 3:
+            break
+        time.sleep(0.1)
+    owner.stop()
+
+    # Reader takes over once the owner exits - it starts with the last snapshot
+    # and keeps its cache up to date on its own.
+    for _ in range(50):
+        if not reader._read_only:
+            break
+        time.sleep(0.1)
+    response = reader.run_instances(ImageId='ami-03cf127a', MinCount=1, MaxCount=1)
+    reader.stop()
+
+    assert len(reader.get_cached_instance_ids()) == 4
+    assert response['Instances'][0]['InstanceId'] in reader.get_cached_instance_ids()
+
+
+def test_unreachable_endpoint(monkeypatch):
+    class unreachable_ec2:
+        calls = 0
+
+        def describe_instances(self, **kwargs):
+            unreachable_ec2.calls += 1
+            raise ConnectionError('Could not connect to the endpoint URL')
+
+    monkeypatch.setitem(ec2_proxy.ec2_proxy.CIRCUIT_BREAKER_LIMITS, 'failure_threshold', 2)
+    proxy = ec2_proxy.ec2_proxy(backend=unreachable_ec2())
+
+    responses = [proxy.describe_instances() for _ in range(4)]
+
+    # Failing calls are recorded as synthetic responses.
+    for response in responses:
+        assert response['ResponseMetadata']['HTTPStatusCode'] == 503
+        assert response['ResponseMetadata']['RequestId'] in proxy.get_cached_request_ids()
+
+    # Failed refresh returns the failed response.
+    assert proxy.refresh_instances()['Error']['Code'] == ec2_proxy.ec2_proxy.CIRCUIT_OPEN_ERROR_CODE
+
+    # After failure_threshold failures the endpoint is not called anymore.
+    assert unreachable_ec2.calls == 2
+    assert [response['Error']['Code'] for response in responses] == [
+        ec2_proxy.ec2_proxy.ENDPOINT_ERROR_CODE, ec2_proxy.ec2_proxy.ENDPOINT_ERROR_CODE,
+        ec2_proxy.ec2_proxy.CIRCUIT_OPEN_ERROR_CODE, ec2_proxy.ec2_proxy.CIRCUIT_OPEN_ERROR_CODE]
+
+
+def test_apply_instance_states_unknown_ids():
+    backend = fake_ec2.fake_ec2(instances_count=2)
+    instance_ids = [instance['InstanceId']
+                    for reservation in backend.describe_instances()['Reservations']
+                    for instance in reservation['Instances']]
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+
+    # Nonexistent instance does not prevent existing ones from being described.
+    proxy.apply_instance_states({instance_ids[0]: 'running',
+                                 'i-00000000deadbeef0': 'running',
+                                 instance_ids[1]: 'running'})
+
+    assert sorted(proxy.get_cached_instance_ids()) == sorted(instance_ids)
+
+
+def test_invalid_request(monkeypatch):
+    monkeypatch.setitem(ec2_proxy.ec2_proxy.CIRCUIT_BREAKER_LIMITS, 'failure_threshold', 2)
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2())
+
+    # Malformed requests are not failures of the endpoint - they do not open the circuit.
+    for _ in range(4):
+        response = proxy.run_instances(NoSuchParameter=1)
+        assert response['ResponseMetadata']['HTTPStatusCode'] == 400
+        assert response['Error']['Code'] == ec2_proxy.ec2_proxy.INVALID_REQUEST_ERROR_CODE
+
+    response = proxy.run_instances(ImageId='ami-03cf127a', MinCount=1, MaxCount=1)
+    assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+
+
+def test_internal_requests_are_not_cached():
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(instances_count=10))
+
+    proxy.refresh_instances()
+    proxy.refresh_instances()
+    proxy.lookup_instance('i-0123456789abcdef0')
+
+    # Polling and lookups do not evict responses of user's requests.
+    assert len(proxy.get_cached_instance_ids()) == 10
+    assert len(proxy.get_cached_request_ids()) == 0
+
+    response = proxy.describe_instances()
+    assert proxy.get_cached_request_ids() == (response['ResponseMetadata']['RequestId'],)
+
+
+def test_internal_failures_are_cached():
+    class unreachable_ec2:
+        def describe_instances(self, **kwargs):
+            raise ConnectionError('Could not connect to the endpoint URL')
+
+    proxy = ec2_proxy.ec2_proxy(backend=unreachable_ec2())
+
+    response = proxy.refresh_instances()
+
+    # Failures of internal calls are recorded as well.
+    assert response['Error']['Code'] == ec2_proxy.ec2_proxy.ENDPOINT_ERROR_CODE
+    assert proxy.get_cached_request_ids() == (response['ResponseMetadata']['RequestId'],)
@@ -1,6 +1,8 @@
 """ This module tests ec2fs class over FUSE interface. """
 
 
+import csv
+import errno
 import logging
 import os
 import json
@@ -92,4 +94,146 @@ def test_terminate_instances(mocked_ec2fs):
 
             assert 48 == instance_metadata['State']['Code']
             assert 'terminated' == instance_metadata['State']['Name']
-            assert 'Client.UserInitiatedShutdown' == instance_metadata['StateReason']['Code']
\ No newline at end of file
+            assert 'Client.UserInitiatedShutdown' == instance_metadata['StateReason']['Code']
+
+def test_large_directory_listing(mocked_ec2fs):
+    # Entries do not fit into a single kernel buffer, so they are listed in pages.
+    instances_len = 200
+
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as fh:
+        json.dump({
+            'InstanceType': 't2.nano',
+            'MaxCount': instances_len,
+            'MinCount': instances_len,
+            'ImageId': 'ami-03cf127a'
+            },
+            fh
+        )
+
+    instances_files = os.listdir(f'{mocked_ec2fs}/instances')
+
+    assert len(instances_files) == instances_len
+    assert len(set(instances_files)) == instances_len
+    assert instances_files == sorted(instances_files)
+    assert os.stat(f'{mocked_ec2fs}/instances').st_size == instances_len
+
+
+def test_aggregate_files(mocked_ec2fs):
+    instances_len = 5
+
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as fh:
+        json.dump({
+            'InstanceType': 't2.nano',
+            'MaxCount': instances_len,
+            'MinCount': instances_len,
+            'ImageId': 'ami-03cf127a'
+            },
+            fh
+        )
+
+    with open(f'{mocked_ec2fs}/instances.ndjson', 'r') as fh:
+        instances = [json.loads(line) for line in fh]
+
+    assert len(instances) == instances_len
+    assert sorted(instance['InstanceId'] for instance in instances) == \
+        sorted(os.listdir(f'{mocked_ec2fs}/instances'))
+
+    with open(f'{mocked_ec2fs}/tables/instances.csv', 'r') as fh:
+        rows = list(csv.DictReader(fh))
+
+    assert len(rows) == instances_len
+    assert all(row['InstanceType'] == 't2.nano' for row in rows)
+
+
+def test_aggregate_file_snapshot(mocked_ec2fs):
+    instances_len = 5
+
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as fh:
+        json.dump({
+            'InstanceType': 't2.nano',
+            'MaxCount': instances_len,
+            'MinCount': instances_len,
+            'ImageId': 'ami-03cf127a'
+            },
+            fh
+        )
+
+    with open(f'{mocked_ec2fs}/instances.ndjson', 'rb', buffering=0) as fh:
+        data = fh.read(100)
+        # Cache changes while the file is read - the file handle keeps its version.
+        with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as action_fh:
+            json.dump({
+                'InstanceType': 't2.nano',
+                'MaxCount': instances_len,
+                'MinCount': instances_len,
+                'ImageId': 'ami-03cf127a'
+                },
+                action_fh
+            )
+        # Another handle opened after the change gets the new version
+        # (aggregated files bypass the page cache shared by handles).
+        with open(f'{mocked_ec2fs}/instances.ndjson', 'rb', buffering=0) as other_fh:
+            assert len(other_fh.read().splitlines()) == 2 * instances_len
+        data += fh.read()
+
+    assert len(data.splitlines()) == instances_len
+    assert all(json.loads(line) for line in data.splitlines())
+
+
+def test_getattr(mocked_ec2fs):
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'w') as fh:
+        json.dump({
+            'InstanceType': 't2.nano',
+            'MaxCount': 1,
+            'MinCount': 1,
+            'ImageId': 'ami-03cf127a'
+            },
+            fh
+        )
+
+    instance_id = os.listdir(f'{mocked_ec2fs}/instances')[0]
+
+    with open(f'{mocked_ec2fs}/instances/{instance_id}', 'rb') as fh:
+        assert os.stat(f'{mocked_ec2fs}/instances/{instance_id}').st_size == len(fh.read())
+
+    for path in ('.git', 'instances/.hidden', 'actions/autorun.inf', 'tables/x/y'):
+        with pytest.raises(FileNotFoundError):
+            os.stat(f'{mocked_ec2fs}/{path}')
+
+
+def test_action_result_read_back(mocked_ec2fs):
+    instances_len = 2
+
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'r+') as fh:
+        json.dump({
+            'InstanceType': 't2.nano',
+            'MaxCount': instances_len,
+            'MinCount': instances_len,
+            'ImageId': 'ami-03cf127a'
+            },
+            fh
+        )
+        fh.flush()
+        fh.seek(0)
+        response = json.load(fh)
+
+    instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+    _, _, instances_files = next(os.walk(f'{mocked_ec2fs}/instances'))
+
+    assert len(instance_ids) == instances_len
+    assert sorted(instance_ids) == sorted(instances_files)
+
+    # Results are kept per file handle - new handle has none.
+    with open(f'{mocked_ec2fs}/actions/run_instances', 'r') as fh:
+        assert fh.read() == ''
+
+
+def test_malformed_action_payload(mocked_ec2fs):
+    for path, payload in (('refresh', '{"foo": 1}'), ('actions/run_instances', 'not a json')):
+        with open(f'{mocked_ec2fs}/{path}', 'r+b', buffering=0) as fh:
+            with pytest.raises(OSError) as excinfo:
+                fh.write(payload.encode())
+            assert excinfo.value.errno == errno.EINVAL
+
+            fh.seek(0)
+            assert json.load(fh)['Error']['Code'] == 'InvalidRequest'
@@ -0,0 +1,118 @@
+""" This module tests event_feed class. """
+
+
+import json
+import logging
+
+
+from ec2fs import ec2_proxy, event_feed, fake_ec2
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _write_event(spool, event_id, time, instance_id, state):
+    with open(spool, 'a') as fh:
+        fh.write(json.dumps({
+            'id': event_id,
+            'detail-type': 'EC2 Instance State-change Notification',
+            'time': time,
+            'detail': {'instance-id': instance_id, 'state': state}
+        }) + '\n')
+
+
+def test_state_change_events(mocked_ec2_proxy, tmpdir):
+    response = mocked_ec2_proxy.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 1,
+        'MinCount': 1,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    spool = f'{tmpdir}/events.ndjson'
+    feed = event_feed.event_feed(mocked_ec2_proxy, spool)
+
+    _write_event(spool, 'event-2', '2020-06-20T12:00:02Z', instance_id, 'stopped')
+    _write_event(spool, 'event-1', '2020-06-20T12:00:01Z', instance_id, 'stopping')
+    _write_event(spool, 'event-2', '2020-06-20T12:00:02Z', instance_id, 'stopped')
+
+    assert feed.process() == 1
+
+    instance_metadata = mocked_ec2_proxy.get_cached_instance(instance_id)['data']
+
+    assert 80 == instance_metadata['State']['Code']
+    assert 'stopped' == instance_metadata['State']['Name']
+
+    # Events older than already applied ones are ignored.
+    _write_event(spool, 'event-0', '2020-06-20T12:00:00Z', instance_id, 'running')
+
+    assert feed.process() == 0
+    assert 'stopped' == mocked_ec2_proxy.get_cached_instance(instance_id)['data']['State']['Name']
+
+
+def test_unknown_instance_event(ec2_mock, not_mocked_ec2_client, not_mocked_ec2_proxy, tmpdir):
+    ec2_mock.start()
+
+    response = not_mocked_ec2_client.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 1,
+        'MinCount': 1,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    spool = f'{tmpdir}/events.ndjson'
+    feed = event_feed.event_feed(not_mocked_ec2_proxy, spool)
+
+    _write_event(spool, 'event-1', '2020-06-20T12:00:01Z', instance_id, 'pending')
+
+    assert feed.process() == 1
+    # Instance was not cached, so it was described instead.
+    assert instance_id in not_mocked_ec2_proxy.get_cached_instances()
+
+    ec2_mock.stop()
+
+
+def test_malformed_events(tmpdir):
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(instances_count=1))
+    proxy.refresh_instances()
+    instance_id, = proxy.get_cached_instance_ids()
+
+    spool = f'{tmpdir}/events.ndjson'
+    feed = event_feed.event_feed(proxy, spool)
+
+    with open(spool, 'a') as fh:
+        fh.write('not a json\n')
+        fh.write(json.dumps({'id': 'event-0', 'time': 123, 'detail': {}}) + '\n')
+    _write_event(spool, 'event-1', '2020-06-20T12:00:01Z', instance_id, 'stopped')
+
+    # Malformed events are skipped - they do not prevent valid ones from being applied.
+    assert feed.process() == 1
+    assert 'stopped' == proxy.get_cached_instance(instance_id)['data']['State']['Name']
+
+
+def test_events_do_not_hide_changes_from_refresh(tmpdir, monkeypatch):
+    backend = fake_ec2.fake_ec2(instances_count=5)
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+    proxy.refresh_instances()
+
+    instance_id, = backend.change_states(1)
+    spool = f'{tmpdir}/events.ndjson'
+    _write_event(spool, 'event-1', '2020-06-20T12:00:01Z', instance_id, 'stopped')
+    assert event_feed.event_feed(proxy, spool).process() == 1
+
+    described_ids = []
+    describe_instances = backend.describe_instances
+
+    def recording_describe_instances(**kwargs):
+        for instance_filter in kwargs.get('Filters', []):
+            described_ids.extend(instance_filter['Values'])
+        return describe_instances(**kwargs)
+
+    monkeypatch.setattr(backend, 'describe_instances', recording_describe_instances)
+
+    # Event patched only the state - the instance is still described by the refresh,
+    # so its other attributes (addresses, state reason, ...) are up to date.
+    proxy.refresh_instances()
+    assert described_ids == [instance_id]
@@ -0,0 +1,125 @@
+""" This module tests fake_ec2 class (as ec2_proxy backend). """
+
+
+import logging
+
+
+from ec2fs import ec2_proxy
+from ec2fs import fake_ec2
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_refresh_instances():
+    backend = fake_ec2.fake_ec2(instances_count=2500, images_count=10)
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+
+    assert proxy.refresh_instances() == {'Status': 'done', 'Full': True}
+
+    # 2500 instances do not fit into one page.
+    assert len(proxy.get_cached_instances()) == 2500
+
+    instance_ids = backend.change_states(5)
+    assert proxy.refresh_instances() == {'Status': 'done', 'Full': False}
+
+    for instance_id in instance_ids:
+        assert 'stopped' == proxy.get_cached_instance(instance_id)['data']['State']['Name']
+
+
+def test_refresh_keeps_instances_cached_meanwhile(monkeypatch):
+    backend = fake_ec2.fake_ec2(instances_count=10)
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+    proxy.refresh_instances()
+
+    launched = []
+    describe_instance_status = backend.describe_instance_status
+
+    def launch_after_status(**kwargs):
+        # Instance is launched (and cached) right after the status pages were taken.
+        response = describe_instance_status(**kwargs)
+        launched.append(proxy.run_instances(ImageId='ami-03cf127a', MinCount=1, MaxCount=1))
+        return response
+
+    monkeypatch.setattr(backend, 'describe_instance_status', launch_after_status)
+    proxy.refresh_instances()
+
+    instance_id = launched[0]['Instances'][0]['InstanceId']
+    assert proxy.get_cached_instance(instance_id) is not None
+
+
+def test_refresh_instance_gone_meanwhile(monkeypatch):
+    backend = fake_ec2.fake_ec2(instances_count=10)
+    proxy = ec2_proxy.ec2_proxy(backend=backend)
+    proxy.refresh_instances()
+
+    describe_instance_status = backend.describe_instance_status
+
+    def status_with_gone_instance(**kwargs):
+        # Instance is listed by the status call, but it's gone before it's described.
+        response = describe_instance_status(**kwargs)
+        response['InstanceStatuses'].append({
+            'InstanceId': 'i-0123456789abcdef0',
+            'InstanceState': {'Code': 16, 'Name': 'running'}})
+        return response
+
+    monkeypatch.setattr(backend, 'describe_instance_status', status_with_gone_instance)
+    instance_ids = backend.change_states(3)
+
+    assert proxy.refresh_instances() == {'Status': 'done', 'Full': False}
+    for instance_id in instance_ids:
+        assert 'stopped' == proxy.get_cached_instance(instance_id)['data']['State']['Name']
+
+
+def test_run_and_terminate_instances():
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(transition_time=60))
+
+    response = proxy.run_instances(**{
+        'InstanceType': 't2.nano',
+        'MaxCount': 2,
+        'MinCount': 2,
+        'ImageId': 'ami-03cf127a'
+    })
+    instance_id = response['Instances'][0]['InstanceId']
+
+    assert 'pending' == proxy.get_cached_instance(instance_id)['data']['State']['Name']
+
+    proxy.terminate_instances(InstanceIds=[instance_id])
+
+    instance_metadata = proxy.get_cached_instance(instance_id)['data']
+
+    assert 'shutting-down' == instance_metadata['State']['Name']
+    assert 'Client.UserInitiatedShutdown' == instance_metadata['StateReason']['Code']
+
+
+def test_throttling():
+    old_logger_level = logging.getLogger('ec2fs.ec2_proxy').level
+    logging.getLogger('ec2fs.ec2_proxy').setLevel(logging.CRITICAL)
+
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(throttling_rate=1))
+    response = proxy.describe_instances()
+
+    logging.getLogger('ec2fs.ec2_proxy').setLevel(old_logger_level)
+
+    assert response['ResponseMetadata']['HTTPStatusCode'] == 503
+    assert response['Error']['Code'] == 'RequestLimitExceeded'
+
+
+def test_deterministic_fleet():
+    first = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(instances_count=10, seed=7))
+    second = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(instances_count=10, seed=7))
+
+    first.refresh_instances()
+    second.refresh_instances()
+
+    assert first.get_cached_instance_ids() == second.get_cached_instance_ids()
+
+
+def test_unsupported_filter():
+    proxy = ec2_proxy.ec2_proxy(backend=fake_ec2.fake_ec2(instances_count=10))
+
+    # Unsupported filters are not ignored - it would describe the whole fleet.
+    response = proxy.describe_instances(Filters=[{'Name': 'instance-type', 'Values': ['t2.nano']}])
+
+    assert response['ResponseMetadata']['HTTPStatusCode'] == 400
+    assert response['Error']['Code'] == 'InvalidParameterValue'
@@ -0,0 +1,44 @@
+""" This module tests guarded_kv_store class. """
+
+
+import time
+
+
+import expiringdict
+
+
+from ec2fs import guarded_kv_store
+
+
+def test_entries_are_replaced():
+    store = guarded_kv_store.guarded_kv_store()
+    store.insert('key', {'State': {'Name': 'running'}})
+    entry = store.get('key')
+    entry['derived']['attrs'] = 'attrs'
+
+    store.bulk_update([('key', {'State': {'Name': 'stopped'}})])
+
+    # Entries are never modified in place - readers that got the old entry
+    # (without a lock) see consistent data, raw data and derived values.
+    assert entry['data']['State']['Name'] == 'running'
+    assert b'running' in entry['raw_data']
+    assert entry['derived'] == {'attrs': 'attrs'}
+
+    new_entry = store.get('key')
+    assert new_entry['data']['State']['Name'] == 'stopped'
+    assert new_entry['metadata']['size'] == len(new_entry['raw_data'])
+    assert new_entry['metadata']['@timestamp'] == entry['metadata']['@timestamp']
+    assert new_entry['derived'] == {}
+
+
+def test_volatile_store_keys():
+    store = guarded_kv_store.guarded_kv_store(
+        dict_cls=lambda: expiringdict.ExpiringDict(max_len=10, max_age_seconds=0.1),
+        volatile=True)
+    store.insert('key', {})
+
+    assert store.keys() == ('key',)
+
+    # Expired entries are not listed, even though the store was not modified.
+    time.sleep(0.1)
+    assert store.keys() == ()